@@ -0,0 +1,93 @@
+import argparse
+import random
+import time
+import tracemalloc
+from typing import (
+    Callable,
+    Dict,
+    List,
+)
+
+from cbc_lmd.main import (
+    Block,
+    JumpBlock,
+)
+from cbc_lmd.block_store import (
+    BlockStore,
+    StoredBlock,
+)
+
+
+# each strategy is a function that makes a genesis block to build the chain on
+STRATEGIES = {
+    'skip_list': lambda: Block(None),
+    'jump_pointer': lambda: JumpBlock(None),
+    'block_store': lambda: StoredBlock(None, store=BlockStore()),
+}  # type: Dict[str, Callable]
+
+
+def build_chain(genesis, num_blocks: int, fork_rate: float, rng: random.Random) -> List:
+    # a long chain, where each new block sometimes forks off a recent block instead of the tip
+    block_type = type(genesis)
+    blocks = [genesis]
+    for i in range(num_blocks):
+        if rng.random() < fork_rate:
+            parent = blocks[rng.randint(max(0, i - 64), i)]
+        else:
+            parent = blocks[i]
+        blocks.append(block_type(parent))
+    return blocks
+
+
+def bench_strategy(name: str, num_blocks: int, num_queries: int, fork_rate: float, seed: int) -> Dict[str, float]:
+    # tracing allocations slows building down, so the memory is measured on a separate chain
+    tracemalloc.start()
+    blocks = build_chain(STRATEGIES[name](), num_blocks, fork_rate, random.Random(seed))
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del blocks
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    blocks = build_chain(STRATEGIES[name](), num_blocks, fork_rate, rng)
+    create_time = time.perf_counter() - start
+
+    queries = [(rng.choice(blocks), rng.choice(blocks)) for _ in range(num_queries)]
+
+    start = time.perf_counter()
+    for block, other in queries:
+        block.prev_at_height(rng.randint(0, block.height))
+    prev_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for block, other in queries:
+        block.lca(other)
+    lca_time = time.perf_counter() - start
+
+    return {
+        'create_us_per_block': create_time / num_blocks * 1e6,
+        'bytes_per_block': memory / num_blocks,
+        'prev_at_height_us': prev_time / num_queries * 1e6,
+        'lca_us': lca_time / num_queries * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the ancestor indexes blocks can use")
+    parser.add_argument('--blocks', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--fork-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:<14}{:>22}{:>18}{:>22}{:>10}".format(
+        'strategy', 'create (us/block)', 'bytes/block', 'prev_at_height (us)', 'lca (us)'))
+    for name in STRATEGIES:
+        result = bench_strategy(name, args.blocks, args.queries, args.fork_rate, args.seed)
+        print("{:<14}{:>22.2f}{:>18.1f}{:>22.2f}{:>10.2f}".format(
+            name,
+            result['create_us_per_block'],
+            result['bytes_per_block'],
+            result['prev_at_height_us'],
+            result['lca_us'],
+        ))
@@ -0,0 +1,59 @@
+from typing import (
+    Dict,
+    List,
+    Set,
+)
+
+from cbc_lmd.main import Block
+
+
+class FullTreeGhost:
+    # LMD GHOST the naive way, as a baseline: every block is kept in the tree, and each find_head
+    # adds every latest block's weight to all of its ancestors before walking down from genesis.
+    def __init__(self, genesis: Block, weight: Dict[int, int]=None) -> None:
+        self.genesis = genesis
+        self.weight = dict() if weight is None else dict(weight)  # type: Dict[int, int]
+        self.children = {genesis: []}  # type: Dict[Block, List[Block]]
+        self.latest_blocks = dict()  # type: Dict[int, Block]
+
+    def add_block(self, block: Block) -> None:
+        self.children[block] = []
+        self.children[block.parent_block].append(block)
+
+    def add_new_latest_block(self, block: Block, validator: int) -> None:
+        self.latest_blocks[validator] = block
+
+    def find_head(self) -> Block:
+        scores = dict()  # type: Dict[Block, int]
+        for validator, block in self.latest_blocks.items():
+            weight = self.weight.get(validator, 1)
+            while block is not None and block.height >= self.genesis.height:
+                scores[block] = scores.get(block, 0) + weight
+                block = block.parent_block
+
+        # only blocks with a latest block on top of them can be the head
+        latest = set(self.latest_blocks.values())
+        head = self.genesis
+        while True:
+            children = self.scored_children(head, scores)
+            if len(children) == 0:
+                return head
+            # ties are broken as CompressedTree breaks them, by the hash of the block it keeps a node
+            # for in each subtree
+            head = max(
+                (self.node_block(child, scores, latest) for child in children),
+                key=lambda b: (scores[b], hash(b))
+            )
+
+    def scored_children(self, block: Block, scores: Dict[Block, int]) -> List[Block]:
+        return [child for child in self.children[block] if child in scores]
+
+    def node_block(self, block: Block, scores: Dict[Block, int], latest: Set[Block]) -> Block:
+        # the first block in the subtree that is a latest block or where the subtree branches, as
+        # the blocks above it have the same score and are not nodes in a CompressedTree
+        while block not in latest:
+            children = self.scored_children(block, scores)
+            if len(children) != 1:
+                break
+            block = children[0]
+        return block
@@ -0,0 +1,223 @@
+import argparse
+import json
+import random
+import sys
+import time
+from typing import (
+    Dict,
+    List,
+)
+
+from benchmarks.ancestors import build_chain
+from benchmarks.naive_ghost import FullTreeGhost
+from cbc_lmd.main import (
+    Block,
+    CompressedTree,
+)
+from cbc_lmd.message import (
+    LayerStore,
+    ValidatorSet,
+)
+
+# votes are on one of the most recent blocks, as validators mostly build on and vote near the tip
+VOTE_WINDOW = 64
+
+
+def bench_blocks(depth: int, fork_rate: float, num_queries: int, seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    blocks = build_chain(Block(None), depth, fork_rate, rng)
+    create_time = time.perf_counter() - start
+
+    tree = CompressedTree(blocks[0])
+    queries = [(rng.choice(blocks), rng.choice(blocks)) for _ in range(num_queries)]
+    heights = [rng.randint(0, block.height) for block, _ in queries]
+
+    start = time.perf_counter()
+    for (block, _), height in zip(queries, heights):
+        block.prev_at_height(height)
+    prev_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for block, other in queries:
+        tree.find_lca_block(block, other)
+    lca_time = time.perf_counter() - start
+
+    return {
+        'create_us_per_block': create_time / depth * 1e6,
+        'prev_at_height_us': prev_time / num_queries * 1e6,
+        'find_lca_block_us': lca_time / num_queries * 1e6,
+    }
+
+
+def bench_fork_choice(num_validators: int,
+                      depth: int,
+                      fork_rate: float,
+                      num_updates: int,
+                      num_naive_heads: int,
+                      seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    blocks = build_chain(Block(None), depth, fork_rate, rng)
+    votes = [
+        (blocks[rng.randint(max(0, depth - VOTE_WINDOW), depth)], rng.randrange(num_validators))
+        for _ in range(num_updates)
+    ]
+
+    tree = CompressedTree(blocks[0])
+    start = time.perf_counter()
+    for block, validator in votes:
+        tree.add_new_latest_block(block, validator)
+    add_time = time.perf_counter() - start
+
+    tree = CompressedTree(blocks[0])
+    head_time = 0.0
+    for block, validator in votes:
+        tree.add_new_latest_block(block, validator)
+        start = time.perf_counter()
+        tree.find_head()
+        head_time += time.perf_counter() - start
+
+    naive = FullTreeGhost(blocks[0])
+    for block in blocks[1:]:
+        naive.add_block(block)
+    start = time.perf_counter()
+    for block, validator in votes:
+        naive.add_new_latest_block(block, validator)
+    naive_add_time = time.perf_counter() - start
+    # the naive fork choice is slow, so only time it after some of the votes
+    naive_head_time = 0.0
+    every = max(1, num_updates // num_naive_heads)
+    naive = FullTreeGhost(blocks[0])
+    for block in blocks[1:]:
+        naive.add_block(block)
+    for idx, (block, validator) in enumerate(votes):
+        naive.add_new_latest_block(block, validator)
+        if idx % every == every - 1:
+            start = time.perf_counter()
+            naive.find_head()
+            naive_head_time += time.perf_counter() - start
+
+    return {
+        'add_new_latest_block_us': add_time / num_updates * 1e6,
+        'find_head_us': head_time / num_updates * 1e6,
+        'naive_add_new_latest_block_us': naive_add_time / num_updates * 1e6,
+        'naive_find_head_us': naive_head_time / (num_updates // every) * 1e6,
+        'tree_size': tree.size,
+        'full_tree_size': len(blocks),
+    }
+
+
+def bench_messages(num_validators: int, num_rounds: int, seed: int) -> Dict[str, float]:
+    # every validator makes a message each round, and sees half of the others' messages
+    rng = random.Random(seed)
+    val_set = ValidatorSet(num_validators)
+    validators = list(val_set.validators.values())
+    num_seen = 0
+    see_time = 0.0
+    for _ in range(num_rounds):
+        messages = [val.make_new_message() for val in validators]
+        for val in validators:
+            for message in rng.sample(messages, max(1, num_validators // 2)):
+                start = time.perf_counter()
+                val.see_message(message)
+                see_time += time.perf_counter() - start
+                num_seen += 1
+
+    start = time.perf_counter()
+    layer_store = LayerStore(val_set, val_set.genesis, 2 * num_validators // 3 + 1)
+    layer_time = time.perf_counter() - start
+
+    return {
+        'see_message_us': see_time / num_seen * 1e6,
+        'layer_store_ms': layer_time * 1e3,
+        'num_layers': len(layer_store.layers),
+    }
+
+
+def run_suite(validators: List[int],
+              depths: List[int],
+              fork_rates: List[float],
+              num_updates: int,
+              num_queries: int,
+              num_rounds: int,
+              seed: int) -> List[Dict]:
+    results = []  # type: List[Dict]
+    for depth in depths:
+        for fork_rate in fork_rates:
+            params = {'depth': depth, 'fork_rate': fork_rate}
+            results.append({
+                'benchmark': 'blocks',
+                'params': params,
+                'metrics': bench_blocks(depth, fork_rate, num_queries, seed),
+            })
+            for num_validators in validators:
+                params = {'validators': num_validators, 'depth': depth, 'fork_rate': fork_rate}
+                results.append({
+                    'benchmark': 'fork_choice',
+                    'params': params,
+                    'metrics': bench_fork_choice(num_validators, depth, fork_rate, num_updates, 20, seed),
+                })
+    for num_validators in validators:
+        results.append({
+            'benchmark': 'messages',
+            'params': {'validators': num_validators, 'rounds': num_rounds},
+            'metrics': bench_messages(num_validators, num_rounds, seed),
+        })
+    return results
+
+
+def regressions(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    # the timings that are more than tolerance slower than in the baseline run
+    baseline_metrics = {
+        (result['benchmark'], json.dumps(result['params'], sort_keys=True)): result['metrics'] for result in baseline
+    }
+    slower = []  # type: List[str]
+    for result in results:
+        old_metrics = baseline_metrics.get((result['benchmark'], json.dumps(result['params'], sort_keys=True)), {})
+        for key, value in result['metrics'].items():
+            if not (key.endswith('_us') or key.endswith('_ms')) or key not in old_metrics:
+                continue
+            if value > old_metrics[key] * (1 + tolerance):
+                slower.append("{} {} {}: {:.2f} -> {:.2f}".format(
+                    result['benchmark'], result['params'], key, old_metrics[key], value
+                ))
+    return slower
+
+
+def format_metric(value: float) -> str:
+    return str(value) if isinstance(value, int) else '{:.2f}'.format(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the hot paths, against a naive LMD GHOST baseline")
+    parser.add_argument('--validators', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--depths', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--fork-rates', type=float, nargs='+', default=[0.0, 0.1, 0.3])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help="write the results here, as JSON")
+    parser.add_argument('--baseline', type=str, default=None, help="JSON results to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_suite(
+        args.validators, args.depths, args.fork_rates, args.updates, args.queries, args.rounds, args.seed
+    )
+    for result in results:
+        print("{:<12}{:<50}{}".format(
+            result['benchmark'],
+            ' '.join('{}={}'.format(key, value) for key, value in result['params'].items()),
+            ' '.join('{}={}'.format(key, format_metric(value)) for key, value in result['metrics'].items()),
+        ))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for line in slower:
+            print("slower: " + line)
+        if len(slower) > 0:
+            sys.exit(1)
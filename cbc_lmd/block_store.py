@@ -0,0 +1,196 @@
+from array import array
+from typing import (
+    List,
+    Optional,
+    Union,
+    cast,
+)
+
+from cbc_lmd.main import (
+    SKIP_LENGTH,
+    Block,
+)
+
+NO_PARENT = -1
+
+
+class BlockStore:
+    # Keeps the block tree in flat integer arrays rather than one python object (and a
+    # SKIP_LENGTH list) per block. A block is just its index into these arrays.
+    def __init__(self) -> None:
+        self.heights = array('i')
+        self.parents = array('i')
+        self.names = array('q')
+        # skip pointers of block i are skips[skip_offsets[i]:skip_offsets[i + 1]], where
+        # the k-th pointer is the ancestor 2**k blocks back. Only pointers that exist are stored.
+        self.skip_offsets = array('q', [0])
+        self.skips = array('i')
+
+    def __len__(self) -> int:
+        return len(self.heights)
+
+    def add(self, parent: int=NO_PARENT, name: int=0) -> int:
+        index = len(self.heights)
+        self.names.append(name)
+        self.parents.append(parent)
+        if parent == NO_PARENT:
+            self.heights.append(0)
+            self.skip_offsets.append(len(self.skips))
+            return index
+
+        height = self.heights[parent] + 1
+        self.heights.append(height)
+
+        # build the skip list
+        skips = self.skips
+        offsets = self.skip_offsets
+        skips.append(parent)
+        block = parent
+        for i in range(1, height.bit_length()):
+            # the 2**i ancestor is the 2**(i - 1) ancestor of the 2**(i - 1) ancestor
+            block = skips[offsets[block] + i - 1]
+            skips.append(block)
+        offsets.append(len(skips))
+        return index
+
+    def block(self, index: int) -> 'StoredBlock':
+        return StoredBlock(store=self, index=index)
+
+    def prev_at_height(self, index: int, height: int) -> int:
+        block_height = self.heights[index]
+        if height > block_height:
+            raise Exception("Block {} at height {} has no prev block at height {}".format(index, block_height, height))
+
+        skips = self.skips
+        offsets = self.skip_offsets
+        while block_height > height:
+            # jump back by the largest power of two that does not pass the height
+            pow_of_two = (block_height - height).bit_length() - 1
+            index = skips[offsets[index] + pow_of_two]
+            block_height -= 1 << pow_of_two
+        return index
+
+    def on_top(self, index: int, ancestor: int) -> bool:
+        height = self.heights[ancestor]
+        if height > self.heights[index]:
+            return False
+        return self.prev_at_height(index, height) == ancestor
+
+    def lca(self, index_1: int, index_2: int) -> int:
+        min_height = min(self.heights[index_1], self.heights[index_2])
+        index_1 = self.prev_at_height(index_1, min_height)
+        index_2 = self.prev_at_height(index_2, min_height)
+
+        if index_1 == index_2:
+            return index_1
+
+        skips = self.skips
+        offsets = self.skip_offsets
+        # both blocks stay at the same height, so have the same number of skip pointers
+        height = min_height
+        for i in range(min_height.bit_length() - 1, -1, -1):
+            if 1 << i > height:
+                continue
+            skip_1 = skips[offsets[index_1] + i]
+            skip_2 = skips[offsets[index_2] + i]
+            if skip_1 != skip_2:
+                index_1 = skip_1
+                index_2 = skip_2
+                height -= 1 << i
+
+        parent = self.parents[index_1]
+        if parent == NO_PARENT or parent != self.parents[index_2]:
+            raise Exception("Blocks {} and {} have no LCA".format(index_1, index_2))
+        return parent
+
+
+class StoredBlock:
+    # A thin handle to a block in a BlockStore. It can be used anywhere a Block is, and
+    # handles to the same index are equal, so they can be created whenever they are needed.
+    __slots__ = ('store', 'index')
+
+    def __init__(self,
+                 parent_block: Optional['StoredBlock']=None,
+                 name: Optional[int]=None,
+                 store: Optional[BlockStore]=None,
+                 index: Optional[int]=None) -> None:
+        if parent_block is not None:
+            store = parent_block.store
+        if store is None:
+            raise Exception("A block without a parent block needs a store")
+        self.store = store  # type: BlockStore
+
+        if index is None:
+            parent = NO_PARENT if parent_block is None else parent_block.index
+            index = store.add(parent, 0 if name is None else name)
+        self.index = index  # type: int
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, StoredBlock) and
+            self.index == other.index and
+            self.store is other.store
+        )
+
+    def __hash__(self) -> int:
+        return self.index
+
+    def __repr__(self) -> str:
+        return "StoredBlock({})".format(self.index)
+
+    @property
+    def height(self) -> int:
+        return self.store.heights[self.index]
+
+    @property
+    def parent_block(self) -> Optional['StoredBlock']:
+        parent = self.store.parents[self.index]
+        if parent == NO_PARENT:
+            return None
+        return StoredBlock(store=self.store, index=parent)
+
+    @property
+    def name(self) -> int:
+        return self.store.names[self.index]
+
+    @name.setter
+    def name(self, name: int) -> None:
+        self.store.names[self.index] = name
+
+    @property
+    def skip_list(self) -> List[Optional['StoredBlock']]:
+        store = self.store
+        skip_list = [None] * SKIP_LENGTH  # type: List[Optional[StoredBlock]]
+        start = store.skip_offsets[self.index]
+        end = store.skip_offsets[self.index + 1]
+        for i in range(end - start):
+            skip_list[i] = StoredBlock(store=store, index=store.skips[start + i])
+        return skip_list
+
+    def prev_at_height(self, height: int) -> 'StoredBlock':
+        index = self.store.prev_at_height(self.index, height)
+        if index == self.index:
+            return self
+        return StoredBlock(store=self.store, index=index)
+
+    def on_top(self, block: 'StoredBlock') -> bool:
+        return self.store.on_top(self.index, block.index)
+
+    def lca(self, other: 'StoredBlock') -> 'StoredBlock':
+        return StoredBlock(store=self.store, index=self.store.lca(self.index, other.index))
+
+
+# a block of a tree, which can be a StoredBlock used in place of a Block
+AnyBlock = Union[Block, StoredBlock]
+
+
+def as_block(block: AnyBlock) -> Block:
+    # StoredBlocks can be used anywhere Blocks are, but are not Blocks to the type checker
+    return cast(Block, block)
+
+
+def as_stored_block(block: AnyBlock) -> StoredBlock:
+    # for the blocks of a tree that have to be in a store, to be written by their index
+    if not isinstance(block, StoredBlock):
+        raise Exception("Block {} is not in a BlockStore".format(block))
+    return block
@@ -0,0 +1,228 @@
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from cbc_lmd.main import Block
+
+NO_BLOCK = -1
+# always allow this many blocks to wait for a rebuild, so small trees are not rebuilt on every add
+MIN_PENDING = 64
+
+
+class LCAIndex:
+    # An index over every known block built on top of the root, answering LCA and ancestor at
+    # height queries in O(1). The LCA comes from an Euler tour of the block tree with a sparse
+    # table for range minimum queries, and the ancestor at height comes from jump pointers into
+    # the ladders of a long path decomposition.
+    #
+    # Blocks are added as they are seen, but the tables are only rebuilt once the pending blocks
+    # outnumber half of the indexed ones, so each add costs amortised O(log n). A pending block
+    # is answered through its closest indexed ancestor, and only queries between two pending
+    # blocks on the same new branch fall back to the blocks' own ancestor lookups.
+    def __init__(self, root: Block) -> None:
+        self.reset(root)
+
+    def reset(self, root: Block) -> None:
+        self.root = root
+        self.ids = dict()  # type: Dict[Block, int]
+        self.blocks = []  # type: List[Block]
+        self.heights = []  # type: List[int]
+        self.parents = []  # type: List[int]
+        self.children = []  # type: List[List[int]]
+        # the closest indexed ancestor (or self) of every block
+        self.anchors = []  # type: List[int]
+        self.num_indexed = 0
+        self.add_block(root, NO_BLOCK)
+        self.rebuild()
+
+    def __contains__(self, block: Block) -> bool:
+        return block in self.ids
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def add_block(self, block: Block, parent: int) -> int:
+        block_id = len(self.blocks)
+        self.ids[block] = block_id
+        self.blocks.append(block)
+        self.heights.append(block.height)
+        self.parents.append(parent)
+        self.children.append([])
+        if parent == NO_BLOCK:
+            self.anchors.append(block_id)
+        else:
+            self.children[parent].append(block_id)
+            self.anchors.append(self.anchors[parent])
+        return block_id
+
+    def add(self, block: Block) -> bool:
+        # add the block, and any of its ancestors above the root that are not known yet
+        if block in self.ids:
+            return True
+
+        root_height = self.heights[0]
+        new_blocks = []
+        while block not in self.ids:
+            if block.height <= root_height:
+                # the block is not built on top of the root
+                return False
+            new_blocks.append(block)
+            block = block.parent_block
+
+        parent = self.ids[block]
+        for new_block in reversed(new_blocks):
+            parent = self.add_block(new_block, parent)
+
+        if len(self.blocks) - self.num_indexed > max(MIN_PENDING, self.num_indexed // 2):
+            self.rebuild()
+        return True
+
+    def prune(self, new_root: Block) -> None:
+        # keep only the blocks on top of the new root
+        if new_root not in self.ids:
+            self.reset(new_root)
+            return
+
+        old_ids = self.ids
+        old_blocks = self.blocks
+        old_children = self.children
+        self.reset(new_root)
+        stack = [(old_ids[new_root], 0)]
+        while len(stack) > 0:
+            old_id, new_id = stack.pop()
+            for child in old_children[old_id]:
+                stack.append((child, self.add_block(old_blocks[child], new_id)))
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        num_blocks = len(self.blocks)
+        heights = self.heights
+        parents = self.parents
+        children = self.children
+
+        # euler tour, and the first time each block is visited in it
+        euler = []  # type: List[int]
+        first = [0] * num_blocks
+        preorder = []  # type: List[int]
+        stack = [(0, 0)]
+        while len(stack) > 0:
+            block_id, child_idx = stack.pop()
+            if child_idx == 0:
+                first[block_id] = len(euler)
+                preorder.append(block_id)
+            euler.append(block_id)
+            if child_idx < len(children[block_id]):
+                stack.append((block_id, child_idx + 1))
+                stack.append((children[block_id][child_idx], 0))
+
+        # sparse table: sparse[k][i] is the highest block in euler[i:i + 2**k]
+        sparse = [euler]
+        k = 1
+        while 1 << k <= len(euler):
+            prev = sparse[k - 1]
+            half = 1 << (k - 1)
+            level = []
+            for i in range(len(euler) - (1 << k) + 1):
+                a = prev[i]
+                b = prev[i + half]
+                level.append(a if heights[a] <= heights[b] else b)
+            sparse.append(level)
+            k += 1
+
+        # jump pointers: jumps[v][k] is the ancestor 2**k blocks back
+        jumps = [[] for _ in range(num_blocks)]  # type: List[List[int]]
+        for block_id in preorder:
+            parent = parents[block_id]
+            if parent == NO_BLOCK:
+                continue
+            jump = jumps[block_id]
+            jump.append(parent)
+            while len(jumps[jump[-1]]) >= len(jump):
+                jump.append(jumps[jump[-1]][len(jump) - 1])
+
+        # long path decomposition: the longest path down from each block, then one ladder per path
+        longest = [1] * num_blocks
+        long_child = [NO_BLOCK] * num_blocks
+        for block_id in reversed(preorder):
+            parent = parents[block_id]
+            if parent != NO_BLOCK and longest[block_id] + 1 > longest[parent]:
+                longest[parent] = longest[block_id] + 1
+                long_child[parent] = block_id
+
+        # every block is on one of the paths, so all of these are filled in below
+        ladders = [([], 0)] * num_blocks  # type: List[Tuple[List[int], int]]
+        for top in preorder:
+            parent = parents[top]
+            if parent != NO_BLOCK and long_child[parent] == top:
+                continue
+            path = [top]
+            while long_child[path[-1]] != NO_BLOCK:
+                path.append(long_child[path[-1]])
+            # extend the ladder up by the length of the path
+            extension = []  # type: List[int]
+            block_id = parent
+            while block_id != NO_BLOCK and len(extension) < len(path):
+                extension.append(block_id)
+                block_id = parents[block_id]
+            ladder = list(reversed(extension)) + path
+            for idx, path_block in enumerate(path):
+                ladders[path_block] = (ladder, len(extension) + idx)
+
+        self.first = first
+        self.sparse = sparse
+        self.jumps = jumps
+        self.ladders = ladders
+        self.num_indexed = num_blocks
+        self.anchors = list(range(num_blocks))
+
+    def indexed_lca(self, id_1: int, id_2: int) -> int:
+        left = self.first[id_1]
+        right = self.first[id_2]
+        if left > right:
+            left, right = right, left
+        k = (right - left + 1).bit_length() - 1
+        a = self.sparse[k][left]
+        b = self.sparse[k][right - (1 << k) + 1]
+        return a if self.heights[a] <= self.heights[b] else b
+
+    def indexed_prev_at_height(self, block_id: int, height: int) -> int:
+        diff = self.heights[block_id] - height
+        if diff == 0:
+            return block_id
+        pow_of_two = diff.bit_length() - 1
+        # the jumped to block has a descendant 2**k below it, so its ladder reaches the rest of the way
+        ladder, idx = self.ladders[self.jumps[block_id][pow_of_two]]
+        return ladder[idx - (diff - (1 << pow_of_two))]
+
+    def lca(self, block_1: Block, block_2: Block) -> Optional[Block]:
+        # returns None if the blocks are not both in the index
+        if block_1 not in self.ids or block_2 not in self.ids:
+            return None
+        id_1 = self.ids[block_1]
+        id_2 = self.ids[block_2]
+        anchor_1 = self.anchors[id_1]
+        anchor_2 = self.anchors[id_2]
+
+        if anchor_1 != anchor_2:
+            # pending blocks hang off their anchors, and contain no indexed blocks below them
+            return self.blocks[self.indexed_lca(anchor_1, anchor_2)]
+        if id_1 == anchor_1 or id_2 == anchor_2:
+            return self.blocks[anchor_1]
+        # both are on new branches from the same block
+        return block_1.lca(block_2)
+
+    def prev_at_height(self, block: Block, height: int) -> Block:
+        if block not in self.ids or height < self.heights[0]:
+            return block.prev_at_height(height)
+        block_id = self.ids[block]
+        if height > self.heights[block_id]:
+            raise Exception("Block {} at height {} has no prev block at height {}".format(
+                block, self.heights[block_id], height))
+
+        anchor = self.anchors[block_id]
+        if height > self.heights[anchor]:
+            return block.prev_at_height(height)
+        return self.blocks[self.indexed_prev_at_height(anchor, height)]
@@ -1,14 +1,23 @@
-import math
 from blist import sortedset
+from contextlib import contextmanager
+from functools import cmp_to_key
 from typing import (
+    Iterable,
+    Iterator,
     List,
     Optional,
     Set,
     Dict,
+    Tuple,
 )
 import random
 
+from cbc_lmd.stats import STATS
+
 SKIP_LENGTH = 32
+# heights of nodes to check one by one, per doubling of the tree size, before searching the
+# dfs order of the tree
+HEIGHTS_TO_SCAN = 8
 
 
 class Block:
@@ -38,27 +47,110 @@ class Block:
     def prev_at_height(self, height: int) -> 'Block':
         if height > self.height:
             raise Exception("Block {} at height {} has no prev block at height {}".format(self, self.height, height))
-        elif height == self.height:
-            return self
-        else:
-            # find the block with the lowest height above that height
-            # that is also in the skip list
-            diff = self.height - height
-            # find the exponent of the smallest power of two
-            pow_of_two = int(math.log(diff, 2))
-            block = self.skip_list[pow_of_two]
-            if block is not None:
-                return block.prev_at_height(height)
-            else:
+        if STATS.enabled:
+            # each jump clears the top bit of the distance left
+            STATS.count('Block.prev_at_height.calls')
+            STATS.count('Block.prev_at_height.hops', bin(self.height - height).count('1'))
+
+        block = self
+        while block.height > height:
+            # jump back by the largest power of two that does not pass the height
+            skip = block.skip_list[(block.height - height).bit_length() - 1]
+            if skip is None:
                 raise Exception("Skip list error")
+            block = skip
+        return block
 
-    def on_top(self, block):
+    def on_top(self, block: 'Block') -> bool:
         if block.height > self.height:
             return False
-        
-        block_at_height = block.prev_at_height(block.height)
+
+        block_at_height = self.prev_at_height(block.height)
         return block == block_at_height
 
+    def lca(self, other: 'Block') -> 'Block':
+        min_height = min(self.height, other.height)
+        block_1 = self.prev_at_height(min_height)
+        block_2 = other.prev_at_height(min_height)
+
+        if block_1 == block_2:
+            return block_1
+
+        for i in range(SKIP_LENGTH):
+            if block_1.skip_list[i] == block_2.skip_list[i]:
+                # i - 1 is the last height that these blocks have different ancestor
+                # that are in the skip list
+                if i == 0:
+                    return block_1.parent_block
+                else:
+                    block_a = block_1.skip_list[i - 1]
+                    block_b = block_2.skip_list[i - 1]
+                    if block_a is not None and block_b is not None:
+                        return block_a.lca(block_b)
+
+        raise Exception("Fuuuuuck 5.0: No LCA")
+
+
+class JumpBlock:
+    # An alternative to the Block skip list: each block stores only its parent and a single
+    # jump pointer, laid out in the skew-binary scheme (Myers, "An applicative random-access
+    # stack"). The height a jump lands on only depends on the height it starts from, so
+    # ancestor and LCA queries still take O(log n) hops.
+    __slots__ = ('height', 'parent_block', 'jump', 'name')
+
+    def __init__(self, parent_block: Optional['JumpBlock']=None, name: Optional[int]=None) -> None:
+        self.parent_block = parent_block
+        self.name = 0 if name is None else name
+        if parent_block is None:
+            self.height = 0
+            self.jump = None  # type: Optional[JumpBlock]
+            return
+
+        self.height = parent_block.height + 1
+        jump = parent_block.jump
+        if jump is not None and jump.jump is not None and \
+                parent_block.height - jump.height == jump.height - jump.jump.height:
+            # two jumps of the same length merge into one that is twice as long (plus one)
+            self.jump = jump.jump
+        else:
+            self.jump = parent_block
+
+    def prev_at_height(self, height: int) -> 'JumpBlock':
+        if height > self.height:
+            raise Exception("Block {} at height {} has no prev block at height {}".format(self, self.height, height))
+
+        block = self
+        while block.height > height:
+            # only the genesis has no jump or parent, and it is at the lowest height
+            jump = block.jump
+            parent = block.parent_block
+            if jump is None or parent is None:
+                raise Exception("Block {} has no prev block at height {}".format(self, height))
+            block = jump if jump.height >= height else parent
+        return block
+
+    def on_top(self, block: 'JumpBlock') -> bool:
+        if block.height > self.height:
+            return False
+        return self.prev_at_height(block.height) == block
+
+    def lca(self, other: 'JumpBlock') -> 'JumpBlock':
+        min_height = min(self.height, other.height)
+        block_1 = self.prev_at_height(min_height)
+        block_2 = other.prev_at_height(min_height)
+
+        # blocks at the same height have jumps to the same height, so they stay level
+        while block_1 != block_2:
+            if block_1.jump != block_2.jump:
+                next_1, next_2 = block_1.jump, block_2.jump
+            else:
+                next_1, next_2 = block_1.parent_block, block_2.parent_block
+            if next_1 is None or next_2 is None:
+                raise Exception("Blocks {} and {} have no LCA".format(self, other))
+            block_1, block_2 = next_1, next_2
+        return block_1
+
+
 class Node:
     parent = None  # type: Node
 
@@ -75,13 +167,15 @@ class Node:
         if parent is not None:
             self.parent = parent
         self.has_weight = has_weight
+        # validators whose latest block is this node
+        self.validators = set()  # type: Set[int]
+        # weight of the validators on this node, and of all validators in its subtree
+        self.weight = 0
+        self.score = 0
 
     @property
     def size(self) -> int:
-        size = 1
-        for child in self.children:
-            size += child.size
-        return size
+        return len(self.nodes_in_subtree())
     
     @property
     def is_leaf(self) -> bool:
@@ -89,37 +183,251 @@ class Node:
 
     def nodes_in_subtree(self) -> Set['Node']:
         nodes = {self}
-        for child in self.children:
-            nodes.update(child.nodes_in_subtree())
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.update(node.children)
+            stack.extend(node.children)
         return nodes
 
 
 class CompressedTree:
-    def __init__(self, genesis: Block):
-        self.latest_block_nodes = dict() # type: Dict[int, Node]
-        self.blocks_at_height = dict() # type: Dict[int, Set[Node]]
+    def __init__(self, genesis: Block, weight: Optional[Dict[int, int]]=None, use_lca_index: bool=False):
+        # validators that have no weight given have weight 1
+        self.weight = dict() if weight is None else dict(weight)  # type: Dict[int, int]
+        self.lca_index = None  # type: Optional[LCAIndex]
+        if use_lca_index:
+            # imported here, as the index is built on top of the blocks in this module
+            from cbc_lmd.lca_index import LCAIndex
+            self.lca_index = LCAIndex(genesis)
+        self.latest_block_nodes = dict() # type: Dict[int, Optional[Node]]
+        self.blocks_at_height = dict() # type: Dict[int, Set[Block]]
         self.node_with_block = dict() # type: Dict[Block, Node]
         self.heights = sortedset(key = lambda x: -x) # store from largest -> smallest
+        self.dfs_order = sortedset(key = cmp_to_key(self.compare_blocks)) # blocks of all nodes
+        self.added_to_dfs_order = set()  # type: Set[Block]
+        self.removed_from_dfs_order = set()  # type: Set[Block]
         self.path_block_to_child_node = dict() # type: Dict[Block, Node]
         self.node_counter = 1
+        # changes whenever the nodes or their scores do
+        self.version = 0
+        # the path from the root to the head the last time it was found, and the shallowest index
+        # on it where GHOST might now choose a different child (or None if it would not)
+        self.head_path = []  # type: List[Node]
+        self.head_path_index = dict()  # type: Dict[Node, int]
+        self.head_dirty_from = 0  # type: Optional[int]
+        # while the tree is forked, the latest block nodes validators had before it was, and the
+        # validators that had none
+        self.fork_latest_block_nodes = None  # type: Optional[Dict[int, Optional[Node]]]
+        self.fork_new_validators = set()  # type: Set[int]
+        # and the weights validators had before it was, or None for those that had none given
+        self.fork_weights = dict()  # type: Dict[int, Optional[int]]
         self.root = self.add_tree_node(genesis, None, True)
+        self.reset_head_path()
 
     # TODO: can this function be in a subclass? I'm thinking that we have an LMD tree...
     # and then we can also do an IMD tree, or something... but we might not get
     # efficiency gains here 
     def add_new_latest_block(self, block: Block, validator: int) -> Node:
         # remove the validators last message, if they have one
-        if validator in self.latest_block_nodes and self.latest_block_nodes[validator]:
-            old_node = self.latest_block_nodes[validator]
-            self.remove_node(old_node)
+        self.remove_latest_block(validator)
         # add the validators new message, and save it
         new_node = self.add_block_with_weight(block)
+        if new_node is not None:
+            new_node.validators.add(validator)
+            self.add_score(new_node, self.validator_weight(validator))
         self.latest_block_nodes[validator] = new_node
         return new_node
 
+    def remove_latest_block(self, validator: int) -> None:
+        self.remember_latest_block(validator)
+        old_node = self.latest_block_nodes.get(validator, None)
+        if old_node is None:
+            return
+        old_node.validators.remove(validator)
+        self.add_score(old_node, -self.validator_weight(validator))
+        # other validators might still have this block as their latest
+        if len(old_node.validators) == 0 and old_node != self.root:
+            self.remove_node(old_node)
+        self.latest_block_nodes[validator] = None
+
+    def add_new_latest_blocks(self, updates: Iterable[Tuple[Block, int]]) -> Dict[int, Optional[Node]]:
+        # applies many (block, validator) updates at once, leaving the tree as if they were added
+        # one by one. Returns the new latest block node of each validator that was updated.
+        new_latest_blocks = dict()  # type: Dict[int, Block]
+        for block, validator in updates:
+            # only the last update from each validator matters
+            new_latest_blocks[validator] = block
+            self.remember_latest_block(validator)
+
+        # remove the old weight in one pass, so every node still has a correct score
+        removed_weight = dict()  # type: Dict[Node, int]
+        old_nodes = set()  # type: Set[Node]
+        for validator, block in new_latest_blocks.items():
+            old_node = self.latest_block_nodes.get(validator, None)
+            if old_node is None:
+                continue
+            old_node.validators.remove(validator)
+            removed_weight[old_node] = removed_weight.get(old_node, 0) - self.validator_weight(validator)
+            old_nodes.add(old_node)
+        self.add_scores(removed_weight)
+
+        # nodes that get a new latest block do not need to be removed and added again
+        new_blocks = set(new_latest_blocks.values())
+        for old_node in old_nodes:
+            if len(old_node.validators) == 0 and old_node != self.root and old_node.block not in new_blocks:
+                self.remove_node(old_node)
+
+        # add blocks before their descendants, so no paths have to be split between them
+        new_nodes = dict()  # type: Dict[Block, Optional[Node]]
+        for block in sorted(new_blocks, key=lambda b: b.height):
+            new_nodes[block] = self.add_block_with_weight(block)
+
+        new_latest_nodes = dict()  # type: Dict[int, Optional[Node]]
+        added_weight = dict()  # type: Dict[Node, int]
+        for validator, block in new_latest_blocks.items():
+            new_node = new_nodes[block]
+            if new_node is not None:
+                new_node.validators.add(validator)
+                added_weight[new_node] = added_weight.get(new_node, 0) + self.validator_weight(validator)
+            self.latest_block_nodes[validator] = new_node
+            new_latest_nodes[validator] = new_node
+        self.add_scores(added_weight)
+        return new_latest_nodes
+
+    @contextmanager
+    def fork(self) -> Iterator['CompressedTree']:
+        # changes to the latest blocks and weights made inside the with block are undone when it
+        # exits. As the tree only depends on the latest blocks and weights, undoing them costs
+        # about as much as making them, and nothing else in the tree is copied.
+        if self.fork_latest_block_nodes is not None:
+            raise Exception("The tree is already forked")
+        self.fork_latest_block_nodes = dict()
+        self.fork_new_validators = set()
+        self.fork_weights = dict()
+        try:
+            yield self
+        finally:
+            latest_block_nodes = self.fork_latest_block_nodes
+            new_validators = self.fork_new_validators
+            old_weights = self.fork_weights
+            self.fork_latest_block_nodes = None
+            self.fork_new_validators = set()
+            self.fork_weights = dict()
+
+            self.set_validator_weights({
+                validator: 1 if weight is None else weight for validator, weight in old_weights.items()
+            })
+            for validator, weight in old_weights.items():
+                if weight is None:
+                    del(self.weight[validator])
+
+            self.add_new_latest_blocks(
+                (node.block, validator) for validator, node in latest_block_nodes.items() if node is not None
+            )
+            for validator, node in latest_block_nodes.items():
+                if node is None:
+                    self.remove_latest_block(validator)
+            for validator in new_validators:
+                self.remove_latest_block(validator)
+                del(self.latest_block_nodes[validator])
+
+    def remember_latest_block(self, validator: int) -> None:
+        # remember the latest block the validator had before the tree was forked
+        if self.fork_latest_block_nodes is None or validator in self.fork_new_validators:
+            return
+        if validator in self.fork_latest_block_nodes:
+            return
+        if validator in self.latest_block_nodes:
+            self.fork_latest_block_nodes[validator] = self.latest_block_nodes[validator]
+        else:
+            self.fork_new_validators.add(validator)
+
+    def validator_weight(self, validator: int) -> int:
+        return self.weight.get(validator, 1)
+
+    def set_validator_weight(self, validator: int, weight: int) -> None:
+        self.set_validator_weights({validator: weight})
+
+    def set_validator_weights(self, weights: Dict[int, int]) -> None:
+        # changes the weights of validators (e.g. for deposits, slashing or a new epoch). Only the
+        # nodes with the validators' latest blocks, and the paths from them to the root, are scored
+        # again.
+        changes = dict()  # type: Dict[Node, int]
+        for validator, weight in weights.items():
+            if self.fork_latest_block_nodes is not None and validator not in self.fork_weights:
+                self.fork_weights[validator] = self.weight.get(validator, None)
+            change = weight - self.validator_weight(validator)
+            self.weight[validator] = weight
+            node = self.latest_block_nodes.get(validator, None)
+            if node is not None and change != 0:
+                changes[node] = changes.get(node, 0) + change
+        if len(changes) > 0:
+            self.add_scores(changes)
+
+    def add_score(self, node: Node, weight: int) -> None:
+        self.version += 1
+        node.weight += weight
+        # every node up to the root has this node in its subtree
+        while node is not None:
+            node.score += weight
+            self.score_changed(node, weight)
+            node = node.parent
+
+    def add_scores(self, weights: Dict[Node, int]) -> None:
+        # like add_score for many nodes, but visits each node on their paths to the root only once
+        self.version += 1
+        score_change = dict()  # type: Dict[Node, int]
+        for node, weight in weights.items():
+            node.weight += weight
+            while node is not None and node not in score_change:
+                score_change[node] = 0
+                node = node.parent
+        for node, weight in weights.items():
+            score_change[node] += weight
+
+        # children are higher than their parents, so pass the change up from the highest nodes
+        for node in sorted(score_change, key=lambda n: -n.block.height):
+            node.score += score_change[node]
+            self.score_changed(node, score_change[node])
+            if node.parent is not None:
+                score_change[node.parent] += score_change[node]
+
+    def score_changed(self, node: Node, change: int) -> None:
+        if change == 0 or node.parent not in self.head_path_index:
+            return
+        if change > 0 and node in self.head_path_index:
+            # the child GHOST chose at the parent only got heavier, so it would still choose it
+            return
+        if len(node.parent.children) == 1:
+            return
+        self.children_changed(node.parent)
+
+    def children_changed(self, node: Node) -> None:
+        # GHOST might choose a different child of the node, if it is on the path to the head
+        self.version += 1
+        idx = self.head_path_index.get(node, None)
+        if idx is not None and (self.head_dirty_from is None or idx < self.head_dirty_from):
+            self.head_dirty_from = idx
+
+    def reset_head_path(self) -> None:
+        self.head_path = [self.root]
+        self.head_path_index = {self.root: 0}
+        self.head_dirty_from = 0
+
     def add_block_with_weight(self, block: Block) -> Node:
+        if block in self.node_with_block:
+            # the block is already in the tree (e.g. the latest block of another validator)
+            if STATS.enabled:
+                STATS.count('CompressedTree.add_block_with_weight.existing_node')
+            node = self.node_with_block[block]
+            node.has_weight = True
+            return node
+
         block.name = self.node_counter
         self.node_counter += 1
+        if self.lca_index is not None:
+            self.lca_index.add(block)
         # node in tree that is the most recent ancestor of block
         prev_node_in_tree = self.find_prev_node_in_tree(block)
         if prev_node_in_tree is None:
@@ -127,28 +435,37 @@ class CompressedTree:
             return None
 
         # the child of prev_node_in_tree.block that is on the path to block
-        path_block = block.prev_at_height(prev_node_in_tree.block.height + 1)
+        path_block = self.find_prev_at_height(block, prev_node_in_tree.block.height + 1)
 
         # if this path_block points to a child, then the block has path overlap 
         # with some child of prev_node_in_tree
         if path_block in self.path_block_to_child_node:
+            if STATS.enabled:
+                STATS.count('CompressedTree.add_block_with_weight.path_overlap')
             path_overlap_child = self.path_block_to_child_node[path_block]
             block_and_child_lca = self.find_lca_block(block, path_overlap_child.block)
 
             assert block_and_child_lca != prev_node_in_tree.block # if this was true, there would be no path overlap!
 
+            # if the block is itself the lca, it sits on the path to the child, and is the anc_node
+            block_is_lca = block_and_child_lca == block
             anc_node = self.add_tree_node(
                 block=block_and_child_lca,
                 parent=prev_node_in_tree,
                 children={path_overlap_child}, # missing node with new block, as not created yet
-                has_weight=False
+                has_weight=block_is_lca
             )
+            # the new node has no weight yet, so the anc_node's subtree weighs the same as the child's
+            anc_node.score = path_overlap_child.score
 
-            node = self.add_tree_node(block=block, parent=anc_node, has_weight=True)
+            if block_is_lca:
+                node = anc_node
+            else:
+                node = self.add_tree_node(block=block, parent=anc_node, has_weight=True)
 
             # update the path_overlap_child to have correct parent and path pointers
             path_overlap_child.parent = anc_node
-            child_path_block = path_overlap_child.block.prev_at_height(block_and_child_lca.height + 1)
+            child_path_block = self.find_prev_at_height(path_overlap_child.block, block_and_child_lca.height + 1)
             self.path_block_to_child_node[child_path_block] = path_overlap_child
 
             # children of the prev_node_in_tree should not have old child anymore (it is a child of anc_node)
@@ -158,6 +475,8 @@ class CompressedTree:
         else:
             # there is no path overlap between the the block and any child of prev_node_in tree
             # (which might be because the prev_node_in_tree is a leaf and so has no children)
+            if STATS.enabled:
+                STATS.count('CompressedTree.add_block_with_weight.no_overlap')
             node = self.add_tree_node(
                 block=block, 
                 parent=prev_node_in_tree, 
@@ -168,12 +487,14 @@ class CompressedTree:
     def add_tree_node(self, block: Block, parent: Node, has_weight: bool, children:Set[Node]=None) -> Node:
         node = Node(block, parent, has_weight, children=children)
         self.node_with_block[block] = node
+        self.add_to_dfs_order(block)
 
         if parent is not None:
             # add it as a child of its parent
             parent.children.add(node)
+            self.children_changed(parent)
             # point to it with a path_block
-            path_block = block.prev_at_height(parent.block.height + 1)
+            path_block = self.find_prev_at_height(block, parent.block.height + 1)
             self.path_block_to_child_node[path_block] = node
 
         # save it as a node at that height
@@ -186,51 +507,91 @@ class CompressedTree:
         return node
 
     def find_prev_node_in_tree(self, block: Block) -> Optional[Node]:
-        for height in self.heights:
-            # self.heights is in decreasing order
-            if height <= block.height:
-                prev_at_height = block.prev_at_height(height)
-                if prev_at_height in self.blocks_at_height[height]:
-                    # have to get block at that height
-                    return self.node_with_block[prev_at_height]
-        # The block has no previous block in the tree
-        return None
-
-    """
-    # NOTE: this method is broken. It assumes that if some block has a previous^n node in the 
-    # tree at height h, then it has a node in the tree at all heights less than h that are in
-    # in the tree. But this is not the case... so the method does not work!
-    def find_prev_in_tree_with_heights(self, block: Block, heights: List[int], lo: int, hi: int) -> Optional[Node]:
-        if hi <= lo:
-            # TODO: figure out if this should just be less than...
+        if block.height < self.root.block.height or not block.on_top(self.root.block):
+            # The block has no previous block in the tree
             return None
+        if block in self.node_with_block:
+            if STATS.enabled:
+                STATS.count('CompressedTree.find_prev_node_in_tree.is_node')
+            return self.node_with_block[block]
+        if block.parent_block in self.node_with_block:
+            # most blocks are built directly on the latest block of some validator
+            if STATS.enabled:
+                STATS.count('CompressedTree.find_prev_node_in_tree.parent_is_node')
+            return self.node_with_block[block.parent_block]
+
+        # the closest few heights below the block are cheap to check directly
+        # self.heights is in decreasing order
+        first_below = self.heights.bisect_left(block.height)
+        last_to_scan = min(len(self.heights), first_below + HEIGHTS_TO_SCAN * len(self.node_with_block).bit_length())
+        for idx in range(first_below, last_to_scan):
+            height = self.heights[idx]
+            prev_at_height = self.find_prev_at_height(block, height)
+            if prev_at_height in self.blocks_at_height[height]:
+                if STATS.enabled:
+                    STATS.count('CompressedTree.find_prev_node_in_tree.found_by_scan')
+                    STATS.count('CompressedTree.find_prev_node_in_tree.heights_scanned', idx - first_below + 1)
+                return self.node_with_block[prev_at_height]
+        if STATS.enabled:
+            STATS.count('CompressedTree.find_prev_node_in_tree.found_by_dfs_order')
+            STATS.count('CompressedTree.find_prev_node_in_tree.heights_scanned', last_to_scan - first_below)
+
+        # the last node before the block in the dfs order has the same deepest ancestor in the
+        # tree as the block, and the block and it branch at their lca
+        self.update_dfs_order()
+        prev_in_order = self.dfs_order[self.dfs_order.bisect_right(block) - 1]
+        lca = self.find_lca_block(prev_in_order, block)
+        if lca in self.node_with_block:
+            return self.node_with_block[lca]
+
+        # otherwise, the lca is on the path to some node, which is the first node after it in the
+        # dfs order, and the deepest ancestor is the parent of that node
+        next_in_order = self.dfs_order[self.dfs_order.bisect_right(lca)]
+        return self.node_with_block[next_in_order].parent
+
+    def add_to_dfs_order(self, block: Block) -> None:
+        # the dfs order is only updated when it is needed, so nodes that are added and then
+        # removed in between never cost anything
+        if block in self.removed_from_dfs_order:
+            self.removed_from_dfs_order.remove(block)
+        else:
+            self.added_to_dfs_order.add(block)
 
-        mid_idx = int((lo + hi) / 2)
-        mid_height = heights[mid_idx]
-        block_at_mid = block.prev_at_height(mid_height)
-        #node_at_mid = self.node_with_block(block_at_mid, self.nodes_at_height[mid_height])
-        if node_at_mid is not None:
-            if mid_idx + 1 >= len(heights):
-                return node_at_mid
-
-            mid_height_next = heights[mid_idx + 1]
-            if block.height < mid_height_next:
-                return node_at_mid
-
-            block_at_mid_next = block.prev_at_height(mid_height_next)
-            if self.node_with_block(block_at_mid_next, self.nodes_at_height[mid_height_next]) is None:
-                return node_at_mid
-            else:
-                return self.find_prev_in_tree_with_heights(block, heights, mid_idx + 1, hi)
+    def remove_from_dfs_order(self, block: Block) -> None:
+        if block in self.added_to_dfs_order:
+            self.added_to_dfs_order.remove(block)
         else:
-            return self.find_prev_in_tree_with_heights(block, heights, lo, mid_idx)
-    """
+            self.removed_from_dfs_order.add(block)
+
+    def update_dfs_order(self) -> None:
+        for block in self.removed_from_dfs_order:
+            self.dfs_order.remove(block)
+        for block in self.added_to_dfs_order:
+            self.dfs_order.add(block)
+        self.removed_from_dfs_order = set()
+        self.added_to_dfs_order = set()
+
+    def compare_blocks(self, block_1: Block, block_2: Block) -> int:
+        # orders blocks as a depth first search of the block tree, that visits siblings in order
+        # of their hash. Ancestors come before their descendants.
+        if block_1 == block_2:
+            return 0
+        lca = self.find_lca_block(block_1, block_2)
+        if lca == block_1:
+            return -1
+        if lca == block_2:
+            return 1
+        # compare the children of the lca that the blocks are built on
+        child_1 = self.find_prev_at_height(block_1, lca.height + 1)
+        child_2 = self.find_prev_at_height(block_2, lca.height + 1)
+        return -1 if hash(child_1) < hash(child_2) else 1
 
     def remove_node(self, node: Node) -> None:
         def del_node_no_child(node: Node) -> None:
             assert node.is_leaf
 
             node.parent.children.remove(node)
+            self.children_changed(node.parent)
             self.blocks_at_height[node.block.height].remove(node.block)
             # only keep heights that have nodes in them
             if not any(self.blocks_at_height[node.block.height]):
@@ -239,11 +600,12 @@ class CompressedTree:
 
             # get the path block if it might exist
             if node.parent is not None:
-                path_block = node.block.prev_at_height(node.parent.block.height + 1)
+                path_block = self.find_prev_at_height(node.block, node.parent.block.height + 1)
                 del(self.path_block_to_child_node[path_block])
 
             # delete the node
             del(self.node_with_block[node.block])
+            self.remove_from_dfs_order(node.block)
             del(node)
 
         def del_node_with_child(node: Node) -> None:
@@ -254,9 +616,11 @@ class CompressedTree:
             child = node.children.pop()
             child.parent = node.parent
             node.parent.children.add(child)
+            self.children_changed(node.parent)
 
-            # update the path_block_to_child_node map
-            next_block = node.block.prev_at_height(node.parent.block.height + 1)
+            # update the path_block_to_child_node map, removing the child's path from the node
+            del(self.path_block_to_child_node[self.find_prev_at_height(child.block, node.block.height + 1)])
+            next_block = self.find_prev_at_height(node.block, node.parent.block.height + 1)
             assert self.path_block_to_child_node[next_block] == node
             self.path_block_to_child_node[next_block] = child
 
@@ -269,6 +633,7 @@ class CompressedTree:
                 self.heights.remove(node.block.height)
 
             del(self.node_with_block[node.block])
+            self.remove_from_dfs_order(node.block)
             del(node)
 
         num_children = len(node.children)
@@ -288,62 +653,123 @@ class CompressedTree:
                 del_node_with_child(parent)
 
     def find_lca_block(self, block_1: Block, block_2: Block) -> Block:
-        min_height = min(block_1.height, block_2.height)
-        block_1 = block_1.prev_at_height(min_height)
-        block_2 = block_2.prev_at_height(min_height)
+        if self.lca_index is not None:
+            lca = self.lca_index.lca(block_1, block_2)
+            if lca is not None:
+                return lca
+        return block_1.lca(block_2)
 
-        if block_1 == block_2:
-            return block_1
-
-        for i in range(SKIP_LENGTH):
-            if block_1.skip_list[i] == block_2.skip_list[i]:
-                # i - 1 is the last height that these blocks have different ancestor
-                # that are in the skip list
-                if i == 0:
-                    return block_1.parent_block
-                else:
-                    block_a = block_1.skip_list[i - 1]
-                    block_b = block_2.skip_list[i - 1]
-                    if block_a is not None and block_b is not None:
-                        return self.find_lca_block(block_a, block_b)
-
-        raise Exception("Fuuuuuck 5.0: No LCA")
+    def find_prev_at_height(self, block: Block, height: int) -> Block:
+        if self.lca_index is not None:
+            return self.lca_index.prev_at_height(block, height)
+        return block.prev_at_height(height)
 
     @property
     def size(self) -> int:
-        return self.root.size
+        # every node in the tree has its block in node_with_block
+        return len(self.node_with_block)
 
     def all_nodes(self) -> Set[Node]:
         return self.root.nodes_in_subtree()
 
-    def delete_non_subtree(self, new_finalised: Node, node: Node) -> None:
-        if node != new_finalised:
-            for child in node.children:
-                self.delete_non_subtree(new_finalised, child)
-                # TODO: actually delete the node, updating the cached things properly!
+    def delete_non_subtree(self, new_finalised: Node, node: Node) -> Set[int]:
+        # deletes every node below node, apart from the subtree of new_finalised, and returns the
+        # validators whose latest block was deleted. Only the deleted nodes are visited.
+        deleted_validators = set()  # type: Set[int]
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.parent is not None:
+                path_block = self.find_prev_at_height(node.block, node.parent.block.height + 1)
+                del(self.path_block_to_child_node[path_block])
+            if node == new_finalised:
+                continue
+            stack.extend(node.children)
 
-    def prune(self, new_finalised: Node) -> None:
+            del(self.node_with_block[node.block])
+            self.remove_from_dfs_order(node.block)
+            height = node.block.height
+            self.blocks_at_height[height].remove(node.block)
+            if not any(self.blocks_at_height[height]):
+                del(self.blocks_at_height[height])
+                self.heights.remove(height)
+
+            for validator in node.validators:
+                # the latest block is not on top of the new root, just like a block that never was
+                self.latest_block_nodes[validator] = None
+            deleted_validators.update(node.validators)
+        return deleted_validators
+
+    def prune(self, new_finalised: Node) -> Set[int]:
+        # returns the validators whose latest blocks are not on top of new_finalised. They count
+        # for nothing until they have a new latest block.
+        if self.fork_latest_block_nodes is not None:
+            raise Exception("Pruning cannot be undone, so a forked tree cannot be pruned")
+        deleted_validators = self.delete_non_subtree(new_finalised, self.root)
         new_finalised.parent = None
-        self.delete_non_subtree(new_finalised, self.root)
+        # the root is always kept, just like genesis
+        new_finalised.has_weight = True
         self.root = new_finalised
+        self.version += 1
+        self.reset_head_path()
+        # drop the deleted blocks now, so nothing in the tree refers to them
+        self.update_dfs_order()
+        if self.lca_index is not None:
+            self.lca_index.prune(new_finalised.block)
+        return deleted_validators
+
+    def could_be_head(self, block: Block) -> bool:
+        # whether GHOST could choose the block as the head, if it broke ties the right way
+        node = self.node_with_block.get(block, None)
+        if node is None or len(node.children) > 0:
+            return False
+        while node != self.root:
+            if any(child.score > node.score for child in node.parent.children):
+                return False
+            node = node.parent
+        return True
 
     def calculate_scores(self, node: Node, weight: Dict[Block, int], score: Dict[Node, int]) -> Dict[Block, int]:
-        if not any(node.children):
-            score[node] = weight.get(node.block, 0)
-        else:
-            score[node] = weight.get(node.block, 0)
-            for child in node.children:
-                self.calculate_scores(child, weight, score)
-                score[node] += score[child]
+        # visit the nodes parent first, so children can be added to their parents in reverse
+        order = [node]
+        for visiting in order:
+            score[visiting] = weight.get(visiting.block, 0)
+            order.extend(visiting.children)
+        for visiting in reversed(order[1:]):
+            score[visiting.parent] += score[visiting]
+        if STATS.enabled:
+            STATS.count('CompressedTree.calculate_scores.nodes_visited', len(order))
         return score
 
-    def find_head(self, weight: Dict[Block, int]) -> Node:
+    def find_head(self, weight: Optional[Dict[Block, int]]=None) -> Node:
+        if weight is None:
+            # the scores are kept up to date as latest blocks are added, so just run GHOST, from
+            # the first node on the last path to the head where it might choose differently
+            if self.head_dirty_from is not None:
+                if STATS.enabled:
+                    STATS.count('CompressedTree.find_head.reruns')
+                    STATS.count('CompressedTree.find_head.path_kept', self.head_dirty_from + 1)
+                for node in self.head_path[self.head_dirty_from + 1:]:
+                    del(self.head_path_index[node])
+                del(self.head_path[self.head_dirty_from + 1:])
+                node = self.head_path[-1]
+                while len(node.children) > 0:
+                    # ties are broken by the hash of the block, so validators that share blocks
+                    # choose the same head from the same latest blocks
+                    node = max(node.children, key=lambda n: (n.score, hash(n.block)))
+                    self.head_path_index[node] = len(self.head_path)
+                    self.head_path.append(node)
+                if STATS.enabled:
+                    STATS.count('CompressedTree.find_head.path_length', len(self.head_path))
+                self.head_dirty_from = None
+            return self.head_path[-1]
+
         # calculate the score for each block
         scores = self.calculate_scores(self.root, weight, dict())
 
         # run GHOST
         node = self.root
         while len(node.children) > 0:
-            node = max(node.children, key=lambda n: scores.get(n, 0))
+            node = max(node.children, key=lambda n: (scores.get(n, 0), hash(n.block)))
         return node
 
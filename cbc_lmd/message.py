@@ -1,21 +1,34 @@
+from bisect import bisect_left
+
 from cbc_lmd.main import CompressedTree, Block
+from cbc_lmd.persistent import PersistentMap
 
 from typing import (
+    Callable,
+    Iterable,
     List,
     Optional,
     Set,
     Dict,
+    Type,
 )
 
+# only look for the latest messages that changed since the previous message while fewer than
+# 1 / MAX_CHANGED_FRACTION of them have
+MAX_CHANGED_FRACTION = 64
+
 class Message:
 
-    def __init__(self, sender, block: Block, latest_messages, prev_message: 'Message'=None):
+    def __init__(self, sender, block: Block, latest_messages, prev_message: Optional['Message']=None):
         self.sender = sender
         self.block = block
         self.prev_message = prev_message
-        self.latest_messages = dict()
-        for val in latest_messages:
-            self.latest_messages[val] = latest_messages[val]
+        # validators keep their latest messages in a persistent map, so a message can keep the map
+        # as it is, sharing almost all of it with the validator's other messages
+        if isinstance(latest_messages, PersistentMap):
+            self.latest_messages = latest_messages
+        else:
+            self.latest_messages = PersistentMap(latest_messages)
 
         if prev_message is not None:
             self.message_height = prev_message.message_height + 1
@@ -28,50 +41,130 @@ class Validator:
     def __init__(self, name, genesis: Block, weight):
         self.name = name
         self.weight = weight
-        self.tree = CompressedTree(genesis)
+        self.tree = CompressedTree(genesis, weight)
+        # the head, and the version of the tree it was found in (none yet, so the genesis is only
+        # a placeholder)
+        self.head = genesis  # type: Block
+        self.head_version = None  # type: Optional[int]
         self.justification = set()
-        self.latest_messages = dict()
+        self.latest_messages = PersistentMap()
         self.own_message_at_height = dict()
+        # a WriteAheadLog to record the messages seen and made in, if any
+        self.wal = None
 
     def see_message(self, message: Message) -> None:
-        for val in message.latest_messages:
-            prev_message = message.latest_messages[val]
-            if prev_message not in self.justification:
-                self.see_message(prev_message)
-        self.justification.add(message)
-        new_latest = False
-        if message.sender not in self.latest_messages:
-            self.latest_messages[message.sender] = message
-            new_latest = True
-        else:
-            if message.message_height > self.latest_messages[message.sender].message_height:
-                self.latest_messages[message.sender] = message
-                new_latest = True
-        
-        # only add the message to the reduced tree if it is a new later message
-        if new_latest:
-            self.tree.add_new_latest_block(message.block, message.sender)
+        new_latest_messages = dict()  # type: Dict[int, Message]
+        unseen = self.unseen_justification(message)
+        if self.wal is not None:
+            self.wal.log_messages(unseen)
+        for unseen_message in unseen:
+            self.justification.add(unseen_message)
+            sender = unseen_message.sender
+            latest_message = new_latest_messages.get(sender, self.latest_messages.get(sender, None))
+            if latest_message is None or unseen_message.message_height > latest_message.message_height:
+                new_latest_messages[sender] = unseen_message
+
+        # only the final latest message of each sender needs to be added to the reduced tree
+        if len(new_latest_messages) > 0:
+            self.latest_messages = self.latest_messages.update(new_latest_messages)
+            self.tree.add_new_latest_blocks(
+                (latest_message.block, sender) for sender, latest_message in new_latest_messages.items()
+            )
+
+    def unseen_justification(self, message: Message) -> List[Message]:
+        # the message and the messages in its justification that have not been seen, ordered so
+        # every message comes after the messages it justifies. Found without recursing, as
+        # justifications can be very long.
+        if message in self.justification:
+            return []
+        unseen = []  # type: List[Message]
+        visited = {message}
+        stack = [(message, self.new_dependencies(message))]
+        while len(stack) > 0:
+            current, dependencies = stack[-1]
+            for prev_message in dependencies:
+                if prev_message not in visited and prev_message not in self.justification:
+                    visited.add(prev_message)
+                    stack.append((prev_message, self.new_dependencies(prev_message)))
+                    break
+            else:
+                stack.pop()
+                unseen.append(current)
+        return unseen
+
+    def new_dependencies(self, message: Message) -> Iterable[Message]:
+        prev_message = message.prev_message
+        if prev_message is not None and (
+            prev_message in self.justification or message.latest_messages.get(message.sender, None) is prev_message
+        ):
+            # everything the previous message justifies is seen along with it, so only the latest
+            # messages that changed since it are new. Finding changes is much slower per message
+            # than just going through them all, so only do it while there are few of them.
+            max_changed = len(message.latest_messages) // MAX_CHANGED_FRACTION
+            changed = []  # type: List[Message]
+            for _, latest_message in message.latest_messages.changed_items(prev_message.latest_messages):
+                if len(changed) >= max_changed:
+                    break
+                changed.append(latest_message)
+            else:
+                return changed
+        return message.latest_messages.values()
+
+    def message_is_valid(self, message: Message) -> bool:
+        # a valid message builds on a head LMD GHOST could choose, given the latest messages in its
+        # justification. Rather than building a tree from them, change the latest messages that
+        # differ in a fork of the validator's own tree.
+        with self.tree.fork():
+            self.tree.add_new_latest_blocks(
+                (latest_message.block, sender)
+                for sender, latest_message in message.latest_messages.changed_items(self.latest_messages)
+            )
+            for sender, _ in self.latest_messages.changed_items(message.latest_messages):
+                if sender not in message.latest_messages:
+                    self.tree.remove_latest_block(sender)
+            return self.tree.could_be_head(message.block.parent_block)
 
     def forkchoice(self) -> Block:
-        return self.tree.find_head(self.weight).block
-
-    def make_new_message(self) -> Message:
-        block = Block(self.forkchoice())
+        if self.head_version != self.tree.version:
+            self.head = self.tree.find_head().block
+            self.head_version = self.tree.version
+        return self.head
+
+    def set_validator_weights(self, weights: Dict[int, int]) -> None:
+        if self.wal is not None:
+            self.wal.log_weights(weights)
+        self.weight.update(weights)
+        self.tree.set_validator_weights(weights)
+
+    def make_new_message(self, make_block: Optional[Callable[[Block], Block]]=None) -> Message:
+        head = self.forkchoice()
+        # build the block on the head with make_block, or by default the same kind of block as the
+        # head (e.g. a Block, or a StoredBlock in a BlockStore)
+        block = type(head)(head) if make_block is None else make_block(head)
         prev_message = self.latest_messages.get(self.name, None)
         message = Message(self.name, block, self.latest_messages, prev_message=prev_message)
-        self.latest_messages[self.name] = message
+        if self.wal is not None:
+            self.wal.log_messages([message])
+        self.latest_messages = self.latest_messages.set(self.name, message)
         self.own_message_at_height[message.message_height] = message
+        # the validator's own latest message counts in its fork choice, as it does in the
+        # justification of its next message
+        self.justification.add(message)
+        self.tree.add_new_latest_block(block, self.name)
         return message
 
 
 class ValidatorSet:
 
-    def __init__(self, num_validators, weight=None):
+    def __init__(self,
+                 num_validators: int,
+                 weight: Optional[Dict[int, int]]=None,
+                 genesis: Optional[Block]=None) -> None:
         # give all validators weight 1, by default
         if weight is None:
             weight = {v : 1 for v in range(num_validators)}
         self.weight = weight
-        self.genesis = Block(None)
+        self.genesis = Block(None) if genesis is None else genesis
         self.validators = dict()
         for name in range(num_validators):
             val = Validator(name, self.genesis, weight)
@@ -83,6 +176,12 @@ class ValidatorSet:
     def send_message(self, message, name):
         self.validators[name].see_message(message)
 
+    def set_validator_weights(self, weights: Dict[int, int]) -> None:
+        # the validators share the weights, but each of their trees has its own scores to change,
+        # and each may have a log to record the change in
+        for val in self.validators.values():
+            val.set_validator_weights(weights)
+
     def __iter__(self):
         self.n = 0
         return self
@@ -98,11 +197,16 @@ class ValidatorSet:
 
 class LayerStore:
 
-    def __init__(self, validator_set, block, q): 
+    def __init__(self,
+                 validator_set,
+                 block,
+                 q,
+                 first_layer: Optional[Dict[Validator, Message]]=None,
+                 lower_q_layers: Optional[Dict[int, Dict[Validator, Message]]]=None):
         self.validator_set = validator_set
         self.block = block
         self.q = q
-        self.layers = self.build_all_layers()
+        self.layers = self.build_all_layers(first_layer, lower_q_layers)
 
     def build_first_layer(self) -> Dict[Validator, Message]:
         layer = dict()
@@ -118,39 +222,68 @@ class LayerStore:
                     break
             
             if prev_agreeing_message is not None:
-                layer[val] = message_at_height
+                layer[val] = prev_agreeing_message
 
         return layer
 
-    def build_next_layer(self, prev_layer: Dict[Validator, Message]) -> Dict[Validator, Message]:
+    def build_next_layer(self,
+                         prev_layer: Dict[Validator, Message],
+                         lower_q_layer: Optional[Dict[Validator, Message]]=None) -> Dict[Validator, Message]:
+        # a layer for a lower q, if given, has every validator in this layer, at the same message
+        # or an earlier one
         layer = dict()
 
         for val in prev_layer:
-            prev_layer_boundry_height = prev_layer[val].message_height
-            for i in range(prev_layer_boundry_height, len(val.own_message_at_height)):
-                # see how many messages it acknowledges in the previous layer!
-                total_weight = 0
-                message_at_height = val.own_message_at_height[i]
-                for other_val in prev_layer:
-                    prev_layer_boundry = prev_layer[other_val] # must be defined, as is in V
-                    if other_val.name not in message_at_height.latest_messages:
-                        continue
-                    if message_at_height.latest_messages[other_val.name].message_height >= prev_layer_boundry.message_height:
-                        total_weight += self.validator_set.weight[other_val.name]
+            # a validator's later messages see at least as much of the previous layer as its earlier
+            # ones do, so the first message that sees q weight of it can be binary searched for
+            lo = prev_layer[val].message_height
+            if lower_q_layer is not None:
+                if val not in lower_q_layer:
+                    continue
+                lo = max(lo, lower_q_layer[val].message_height)
+            hi = len(val.own_message_at_height)
+            # for a close q, the message for the lower q usually sees enough already
+            if lower_q_layer is not None and self.weight_seen(val.own_message_at_height[lo], prev_layer) >= self.q:
+                hi = lo
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.weight_seen(val.own_message_at_height[mid], prev_layer) >= self.q:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            if lo < len(val.own_message_at_height):
+                layer[val] = val.own_message_at_height[lo]
+
+        return layer
+
+    def weight_seen(self, message: Message, prev_layer: Dict[Validator, Message]) -> int:
+        # the weight of the validators whose message in the previous layer the message has seen,
+        # stopping once it reaches q
+        total_weight = 0
+        for other_val in prev_layer:
+            latest_message = message.latest_messages.get(other_val.name, None)
+            if latest_message is None:
+                continue
+            if latest_message.message_height >= prev_layer[other_val].message_height:
+                total_weight += self.validator_set.weight[other_val.name]
                 if total_weight >= self.q:
-                    layer[val] = message_at_height
                     break
-                    
-        return layer
+        return total_weight
 
 
-    def build_all_layers(self) -> Dict[int, Dict[Validator, Message]]:
+    def build_all_layers(self,
+                         first_layer: Optional[Dict[Validator, Message]]=None,
+                         lower_q_layers: Optional[Dict[int, Dict[Validator, Message]]]=None
+                         ) -> Dict[int, Dict[Validator, Message]]:
         layer = dict()
-        layer[0] = self.build_first_layer()
+        layer[0] = self.build_first_layer() if first_layer is None else first_layer
 
         prev_layer_height = 0
         while any(layer[prev_layer_height]):
-            layer[prev_layer_height + 1] = self.build_next_layer(layer[prev_layer_height])
+            lower_q_layer = None
+            if lower_q_layers is not None:
+                lower_q_layer = lower_q_layers.get(prev_layer_height + 1, dict())
+            layer[prev_layer_height + 1] = self.build_next_layer(layer[prev_layer_height], lower_q_layer)
             prev_layer_height += 1
 
         return layer
@@ -158,8 +291,9 @@ class LayerStore:
     def add_message(self, message: Message) -> None:
         vals_at_layers = {0: set()}
 
-        for val in message.latest_messages:
-            latest_message = message.latest_messages[val]
+        for name in message.latest_messages:
+            latest_message = message.latest_messages[name]
+            val = self.validator_set.validators[name]
 
             for layer_height in range(len(self.layers) - 1, -1, -1):
                 if val not in self.layers[layer_height]:
@@ -170,27 +304,162 @@ class LayerStore:
                     vals_at_layers[layer_height].add(val)
 
         max_layer = max(vals_at_layers, default=0)
-        weight_at_max_layer = sum([self.validator_set.weight[v] for v in vals_at_layers[max_layer]])
+        weight_at_max_layer = sum([self.validator_set.weight[v.name] for v in vals_at_layers[max_layer]])
+        self.add_to_layer(message, max_layer, weight_at_max_layer)
 
+    def add_to_layer(self, message: Message, max_layer: int, weight_at_max_layer: int) -> None:
+        sender = self.validator_set.validators[message.sender]
         if weight_at_max_layer >= self.q:
             # this message see's at least q weight at layer max_layer, so it's up 1
             if max_layer + 1 not in self.layers:
                 self.layers[max_layer + 1] = dict()
 
-            self.layers[max_layer + 1][message.sender] = message
+            self.layers[max_layer + 1][sender] = message
         else:
             # only add if the node does not already have a message at this layer
-            if message.sender not in self.layers[max_layer]:
-                self.layers[max_layer][message.sender] = message
+            if sender not in self.layers[max_layer]:
+                self.layers[max_layer][sender] = message
 
     def fault_tolerance(self) -> float:
         num_layers = len(self.layers)
-        return (2 * self.q - sum(self.validator_set.weights.values())) / (1 - .5**num_layers)
+        return (2 * self.q - sum(self.validator_set.weight.values())) * (1 - .5**num_layers)
 
     def block_has_fault_tolerance(self, t: float) -> bool:
         return self.fault_tolerance() >= t
 
 
+class PathFinality:
+    # The finality of every block on the path from a root block to the head. A message on top of a
+    # block is on top of all of its ancestors too, so a validator's agreeing suffix only grows going
+    # down the path, and one backwards scan of its messages finds where the suffix starts for every
+    # block. The layers of a block can only be fewer than those of its ancestors, so the number of
+    # layers along the path is found by bisecting, only building layers where it changes.
+    def __init__(self,
+                 validator_set: ValidatorSet,
+                 root: Block,
+                 head: Block,
+                 q: int,
+                 layer_store: Type[LayerStore]=LayerStore) -> None:
+        if not head.on_top(root):
+            raise Exception("Head {} is not on top of root {}".format(head, root))
+        self.validator_set = validator_set
+        self.q = q
+        self.layer_store = layer_store
+        self.path = [head]
+        while self.path[-1].height > root.height:
+            self.path.append(self.path[-1].parent_block)
+        self.path.reverse()
+        # for each validator, the heights its agreeing suffixes start at, and the index of the
+        # last block on the path they agree with, both ascending
+        self.suffix_starts = dict()  # type: Dict[Validator, List[int]]
+        self.suffix_depths = dict()  # type: Dict[Validator, List[int]]
+        for val in validator_set.validators.values():
+            self.find_suffixes(val)
+        self.layer_stores = dict()  # type: Dict[int, LayerStore]
+
+    def depth_on_path(self, block: Block) -> int:
+        # the index of the last block on the path the block is on top of, or -1 if it is not on
+        # top of the root
+        return block.lca(self.path[-1]).height - self.path[0].height
+
+    def find_suffixes(self, val: Validator) -> None:
+        starts = []  # type: List[int]
+        depths = []  # type: List[int]
+        num_messages = len(val.own_message_at_height)
+        # the deepest block all messages from height + 1 on agree with
+        suffix_depth = len(self.path) - 1
+        for height in range(num_messages - 1, -1, -1):
+            depth = min(suffix_depth, self.depth_on_path(val.own_message_at_height[height].block))
+            if depth < suffix_depth:
+                if height + 1 < num_messages:
+                    starts.append(height + 1)
+                    depths.append(suffix_depth)
+                suffix_depth = depth
+                if suffix_depth < 0:
+                    break
+        else:
+            if num_messages > 0:
+                starts.append(0)
+                depths.append(suffix_depth)
+        starts.reverse()
+        depths.reverse()
+        self.suffix_starts[val] = starts
+        self.suffix_depths[val] = depths
+
+    def first_layer(self, idx: int) -> Dict[Validator, Message]:
+        layer = dict()
+        for val, depths in self.suffix_depths.items():
+            suffix = bisect_left(depths, idx)
+            if suffix < len(depths):
+                layer[val] = val.own_message_at_height[self.suffix_starts[val][suffix]]
+        return layer
 
-
-
+    def layers_of(self, idx: int) -> LayerStore:
+        if idx not in self.layer_stores:
+            self.layer_stores[idx] = self.layer_store(
+                self.validator_set, self.path[idx], self.q, first_layer=self.first_layer(idx)
+            )
+        return self.layer_stores[idx]
+
+    def fault_tolerances(self) -> List[float]:
+        fault_tolerances = [0.0] * len(self.path)
+        # if the blocks at both ends of a range have as many layers, so do the blocks between them
+        ranges = [(0, len(self.path) - 1)]
+        while len(ranges) > 0:
+            start, end = ranges.pop()
+            start_layers = self.layers_of(start)
+            end_layers = self.layers_of(end)
+            if len(start_layers.layers) == len(end_layers.layers):
+                for idx in range(start, end + 1):
+                    fault_tolerances[idx] = start_layers.fault_tolerance()
+            else:
+                fault_tolerances[start] = start_layers.fault_tolerance()
+                fault_tolerances[end] = end_layers.fault_tolerance()
+                if end - start > 1:
+                    mid = (start + end) // 2
+                    ranges.append((start, mid))
+                    ranges.append((mid, end))
+        return fault_tolerances
+
+    def highest_block_with_fault_tolerance(self, t: float) -> Optional[Block]:
+        if 2 * self.q < sum(self.validator_set.weight.values()):
+            # the fault tolerance is negative, and so only rises going up the path
+            head_layers = self.layers_of(len(self.path) - 1)
+            return self.path[-1] if head_layers.block_has_fault_tolerance(t) else None
+
+        # the fault tolerance only falls going up the path
+        lo = 0
+        hi = len(self.path)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.layers_of(mid).block_has_fault_tolerance(t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.path[lo - 1] if lo > 0 else None
+
+
+class MultiQuorumLayers:
+    # The layers of a block for each of a list of quorums. A higher q can only make a layer smaller,
+    # or its messages later, so the layers for each q are built from those of the q below it: the
+    # first layer is shared, and the search for a validator's message in a layer starts from its
+    # message in the same layer for the lower q.
+    def __init__(self,
+                 validator_set: ValidatorSet,
+                 block: Block,
+                 qs: Iterable[int],
+                 layer_store: Type[LayerStore]=LayerStore) -> None:
+        self.layer_stores = dict()  # type: Dict[int, LayerStore]
+        first_layer = None  # type: Optional[Dict[Validator, Message]]
+        lower_q_layers = None  # type: Optional[Dict[int, Dict[Validator, Message]]]
+        for q in sorted(set(qs)):
+            layer_store_for_q = layer_store(validator_set, block, q, first_layer, lower_q_layers)
+            self.layer_stores[q] = layer_store_for_q
+            first_layer = layer_store_for_q.layers[0]
+            lower_q_layers = layer_store_for_q.layers
+
+    def layer_counts(self) -> Dict[int, int]:
+        return {q: len(layer_store.layers) for q, layer_store in self.layer_stores.items()}
+
+    def fault_tolerances(self) -> Dict[int, float]:
+        return {q: layer_store.fault_tolerance() for q, layer_store in self.layer_stores.items()}
@@ -0,0 +1,198 @@
+import asyncio
+import random
+import time
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from cbc_lmd.message import (
+    Message,
+    Validator,
+    ValidatorSet,
+)
+
+# the size of a message, less its latest messages, and the size of each latest message in it
+MESSAGE_HEADER_BYTES = 64
+LATEST_MESSAGE_BYTES = 16
+
+
+def constant_latency(latency: float) -> Callable[[int, int, random.Random], float]:
+    return lambda sender, receiver, rng: latency
+
+
+def uniform_latency(low: float, high: float) -> Callable[[int, int, random.Random], float]:
+    return lambda sender, receiver, rng: rng.uniform(low, high)
+
+
+def message_size(message: Message) -> int:
+    # messages only need to carry the latest messages that changed since the sender's last one
+    if message.prev_message is None:
+        num_latest_messages = len(message.latest_messages)
+    else:
+        changed = message.latest_messages.changed_items(message.prev_message.latest_messages)
+        num_latest_messages = sum(1 for _ in changed)
+    return MESSAGE_HEADER_BYTES + LATEST_MESSAGE_BYTES * num_latest_messages
+
+
+def percentile(values: List[float], p: float) -> float:
+    # the nearest rank percentile
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+class Partition:
+    # From start to end (in simulated seconds), messages between validators in different groups
+    # are dropped. Validators in no group can reach no one.
+    def __init__(self, start: float, end: float, groups: List[Set[int]]) -> None:
+        self.start = start
+        self.end = end
+        self.group_of = dict()  # type: Dict[int, int]
+        for idx, group in enumerate(groups):
+            for name in group:
+                self.group_of[name] = idx
+
+    def separates(self, sender: int, receiver: int, now: float) -> bool:
+        if not self.start <= now < self.end:
+            return False
+        group = self.group_of.get(sender, None)
+        return group is None or group != self.group_of.get(receiver, None)
+
+
+class NetworkModel:
+    # How long a message takes to get from one validator to another, if it gets there at all. Each
+    # link sends one message at a time, at its bandwidth (in bytes per simulated second), and the
+    # message then takes the link's latency to arrive.
+    def __init__(self,
+                 latency: Optional[Callable[[int, int, random.Random], float]]=None,
+                 bandwidth: Optional[float]=None,
+                 drop_probability: float=0.0,
+                 partitions: Optional[List[Partition]]=None) -> None:
+        self.latency = constant_latency(0.0) if latency is None else latency
+        self.bandwidth = bandwidth
+        self.drop_probability = drop_probability
+        self.partitions = [] if partitions is None else partitions
+        # when each link is done sending the messages already on it
+        self.link_free_at = dict()  # type: Dict[Tuple[int, int], float]
+
+    def delay(self, sender: int, receiver: int, size: int, now: float, rng: random.Random) -> Optional[float]:
+        # the time until the message arrives, or None if it is dropped
+        if any(partition.separates(sender, receiver, now) for partition in self.partitions):
+            return None
+        if rng.random() < self.drop_probability:
+            return None
+        sent_at = now
+        if self.bandwidth is not None:
+            sent_at = max(now, self.link_free_at.get((sender, receiver), now)) + size / self.bandwidth
+            self.link_free_at[(sender, receiver)] = sent_at
+        return sent_at - now + self.latency(sender, receiver, rng)
+
+
+class NetworkSimulator:
+    # Validators as asyncio tasks, making a message every slot and seeing the messages that reach
+    # them over the network. Time is simulated, with a simulated second taking time_scale real
+    # seconds, so the validators' own work takes (scaled up) simulated time too.
+    def __init__(self,
+                 validator_set: ValidatorSet,
+                 network: NetworkModel,
+                 slot_time: float=1.0,
+                 time_scale: float=0.01,
+                 sample_interval: Optional[float]=None,
+                 seed: int=0) -> None:
+        self.validator_set = validator_set
+        self.network = network
+        self.slot_time = slot_time
+        self.time_scale = time_scale
+        self.sample_interval = slot_time if sample_interval is None else sample_interval
+        self.rng = random.Random(seed)
+        self.start = 0.0
+        self.messages_made = 0
+        self.messages_seen = 0
+        self.messages_dropped = 0
+        # how long each fork choice took to run, in real seconds
+        self.fork_choice_latencies = []  # type: List[float]
+        # the simulated time, and the mean and max size of the validators' trees
+        self.tree_sizes = []  # type: List[Tuple[float, float, int]]
+        self.inboxes = dict()  # type: Dict[int, asyncio.Queue]
+
+    def now(self) -> float:
+        return (asyncio.get_running_loop().time() - self.start) / self.time_scale
+
+    def broadcast(self, message: Message) -> None:
+        loop = asyncio.get_running_loop()
+        size = message_size(message)
+        now = self.now()
+        for name, inbox in self.inboxes.items():
+            if name == message.sender:
+                continue
+            delay = self.network.delay(message.sender, name, size, now, self.rng)
+            if delay is None:
+                self.messages_dropped += 1
+                continue
+            loop.call_later(delay * self.time_scale, inbox.put_nowait, message)
+
+    async def make_messages(self, val: Validator, duration: float) -> None:
+        # start at a random point in the first slot, so validators do not all make messages at once
+        await asyncio.sleep(self.rng.uniform(0, self.slot_time) * self.time_scale)
+        while self.now() < duration:
+            start = time.perf_counter()
+            val.forkchoice()
+            self.fork_choice_latencies.append(time.perf_counter() - start)
+            self.broadcast(val.make_new_message())
+            self.messages_made += 1
+            await asyncio.sleep(self.slot_time * self.time_scale)
+
+    async def see_messages(self, val: Validator) -> None:
+        inbox = self.inboxes[val.name]
+        while True:
+            message = await inbox.get()
+            val.see_message(message)
+            self.messages_seen += 1
+
+    async def sample_tree_sizes(self, duration: float) -> None:
+        while self.now() < duration:
+            sizes = [val.tree.size for val in self.validator_set.validators.values()]
+            self.tree_sizes.append((self.now(), sum(sizes) / len(sizes), max(sizes)))
+            await asyncio.sleep(self.sample_interval * self.time_scale)
+
+    async def simulate(self, duration: float) -> None:
+        self.start = asyncio.get_running_loop().time()
+        validators = list(self.validator_set.validators.values())
+        self.inboxes = {val.name: asyncio.Queue() for val in validators}
+        seeing = [asyncio.ensure_future(self.see_messages(val)) for val in validators]
+        await asyncio.gather(
+            self.sample_tree_sizes(duration),
+            *[self.make_messages(val, duration) for val in validators]
+        )
+        for task in seeing:
+            task.cancel()
+        await asyncio.gather(*seeing, return_exceptions=True)
+
+    def run(self, duration: float) -> Dict[str, object]:
+        # run for duration simulated seconds, and report how it went
+        loop = asyncio.new_event_loop()
+        start = time.perf_counter()
+        try:
+            loop.run_until_complete(self.simulate(duration))
+        finally:
+            loop.close()
+        elapsed = time.perf_counter() - start
+        return {
+            'messages_made': self.messages_made,
+            'messages_seen': self.messages_seen,
+            'messages_dropped': self.messages_dropped,
+            'messages_per_second': self.messages_seen / elapsed if elapsed > 0 else 0.0,
+            'fork_choice_latency': {
+                'p50': percentile(self.fork_choice_latencies, 50),
+                'p90': percentile(self.fork_choice_latencies, 90),
+                'p99': percentile(self.fork_choice_latencies, 99),
+            },
+            'tree_sizes': self.tree_sizes,
+        }
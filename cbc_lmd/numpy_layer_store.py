@@ -0,0 +1,169 @@
+import numpy as np
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from cbc_lmd.main import Block
+from cbc_lmd.message import (
+    MAX_CHANGED_FRACTION,
+    LayerStore,
+    Message,
+    Validator,
+    ValidatorSet,
+)
+
+# the height observed for a validator that has not been seen, and the boundary of a validator
+# that is not in a layer, so it is never counted
+NOT_SEEN = -1
+NOT_IN_LAYER = np.iinfo(np.int32).max
+# keep the rows compared at once to about this many entries, so large validator sets do not need
+# a huge temporary matrix
+MAX_CHUNK_ENTRIES = 1 << 22
+
+
+class MessageMatrix:
+    # Every message added is a row of a matrix, holding the height of the latest message it has
+    # seen from each validator (or NOT_SEEN). Layer stores for the same validator set can share one.
+    def __init__(self, num_validators: int) -> None:
+        self.num_validators = num_validators
+        self.observed = np.full((16, num_validators), NOT_SEEN, dtype=np.int32)
+        self.num_rows = 0
+        self.row_of = dict()  # type: Dict[Message, int]
+        # the rows of each validator's own messages, by message height
+        self.own_rows = [[] for _ in range(num_validators)]  # type: List[List[int]]
+
+    def add_row(self, message: Message) -> int:
+        if message in self.row_of:
+            return self.row_of[message]
+        if self.num_rows == len(self.observed):
+            grown = np.full((2 * len(self.observed), self.num_validators), NOT_SEEN, dtype=np.int32)
+            grown[:self.num_rows] = self.observed
+            self.observed = grown
+        row = self.num_rows
+        self.num_rows += 1
+
+        self.observed[row] = self.observed_heights(message)
+
+        self.row_of[message] = row
+        own_rows = self.own_rows[message.sender]
+        if message.message_height == len(own_rows):
+            own_rows.append(row)
+        return row
+
+    def observed_heights(self, message: Message) -> np.ndarray:
+        prev_message = message.prev_message
+        if prev_message is not None and prev_message in self.row_of:
+            # start from the previous message, and only go through what has changed since it while
+            # few latest messages have, as in Validator.new_dependencies
+            heights = self.observed[self.row_of[prev_message]].copy()
+            max_changed = len(message.latest_messages) // MAX_CHANGED_FRACTION
+            changed = []  # type: List[Tuple[int, Message]]
+            for item in message.latest_messages.changed_items(prev_message.latest_messages):
+                if len(changed) >= max_changed:
+                    break
+                changed.append(item)
+            else:
+                for name, latest_message in changed:
+                    heights[name] = latest_message.message_height
+                return heights
+
+        heights = np.full(self.num_validators, NOT_SEEN, dtype=np.int32)
+        names = []  # type: List[int]
+        message_heights = []  # type: List[int]
+        for name, latest_message in message.latest_messages.items():
+            names.append(name)
+            message_heights.append(latest_message.message_height)
+        heights[names] = message_heights
+        return heights
+
+    def add_own_rows(self, val: Validator) -> None:
+        for height in range(len(self.own_rows[val.name]), len(val.own_message_at_height)):
+            self.add_row(val.own_message_at_height[height])
+
+
+class NumpyLayerStore(LayerStore):
+    # A LayerStore that finds layers with vectorised comparisons. With the messages as rows of a
+    # MessageMatrix, the weight a message sees of a layer is (row >= boundaries) @ weights, where
+    # the boundaries are the heights of the validators' messages in the layer.
+    def __init__(self,
+                 validator_set: ValidatorSet,
+                 block: Block,
+                 q: int,
+                 first_layer: Optional[Dict[Validator, Message]]=None,
+                 lower_q_layers: Optional[Dict[int, Dict[Validator, Message]]]=None,
+                 matrix: Optional[MessageMatrix]=None) -> None:
+        num_validators = len(validator_set.validators)
+        self.weights = np.array([validator_set.weight[name] for name in range(num_validators)])
+        self.matrix = MessageMatrix(num_validators) if matrix is None else matrix
+        super().__init__(validator_set, block, q, first_layer, lower_q_layers)
+
+    def boundaries(self, layer: Dict[Validator, Message]) -> np.ndarray:
+        boundaries = np.full(len(self.weights), NOT_IN_LAYER, dtype=np.int32)
+        for val, message in layer.items():
+            boundaries[val.name] = message.message_height
+        return boundaries
+
+    def build_next_layer(self,
+                         prev_layer: Dict[Validator, Message],
+                         lower_q_layer: Optional[Dict[Validator, Message]]=None) -> Dict[Validator, Message]:
+        matrix = self.matrix
+        for val in prev_layer:
+            matrix.add_own_rows(val)
+        boundaries = self.boundaries(prev_layer)
+
+        # binary search for every validator's first message that sees q weight at once, as in
+        # LayerStore.build_next_layer
+        vals = list(prev_layer)
+        if lower_q_layer is not None:
+            vals = [val for val in vals if val in lower_q_layer]
+        names = np.array([val.name for val in vals], dtype=np.int64)
+        lo = boundaries[names].astype(np.int64)
+        if lower_q_layer is not None and len(vals) > 0:
+            lo = np.maximum(lo, [lower_q_layer[val].message_height for val in vals])
+        num_messages = np.array([len(matrix.own_rows[name]) for name in names], dtype=np.int64)
+        hi = num_messages.copy()
+        num_heights = num_messages.max(initial=0)
+        rows_at_height = np.zeros((len(vals), num_heights), dtype=np.int64)
+        for idx, name in enumerate(names):
+            rows_at_height[idx, :len(matrix.own_rows[name])] = matrix.own_rows[name]
+
+        chunk_size = max(1, MAX_CHUNK_ENTRIES // max(1, len(self.weights)))
+        searching = np.nonzero(lo < hi)[0]
+        # for a close q, the message for the lower q usually sees enough already, so try it first
+        try_lo = lower_q_layer is not None
+        while len(searching) > 0:
+            mid = lo[searching] if try_lo else (lo[searching] + hi[searching]) // 2
+            try_lo = False
+            rows = rows_at_height[searching, mid]
+            has_q = np.empty(len(searching), dtype=bool)
+            for start in range(0, len(searching), chunk_size):
+                end = start + chunk_size
+                seen = matrix.observed[rows[start:end]] >= boundaries
+                has_q[start:end] = seen @ self.weights >= self.q
+            hi[searching[has_q]] = mid[has_q]
+            lo[searching[~has_q]] = mid[~has_q] + 1
+            searching = searching[lo[searching] < hi[searching]]
+
+        layer = dict()
+        for found in np.nonzero(lo < num_messages)[0]:
+            layer[vals[found]] = vals[found].own_message_at_height[int(lo[found])]
+        return layer
+
+    def add_message(self, message: Message) -> None:
+        # adding the row can grow the matrix, so only index it after
+        row = self.matrix.add_row(message)
+        observed = self.matrix.observed[row]
+        # the weight the message sees of each layer, as in LayerStore.add_message
+        layer_boundaries = np.array([self.boundaries(self.layers[height]) for height in range(len(self.layers))])
+        seen = observed >= layer_boundaries
+        seen_layers = np.nonzero(seen.any(axis=1))[0]
+        max_layer = int(seen_layers[-1]) if len(seen_layers) > 0 else 0
+        self.add_to_layer(message, max_layer, seen[max_layer] @ self.weights)
+
+    def fault_tolerance(self) -> float:
+        num_layers = len(self.layers)
+        return (2 * self.q - self.weights.sum()) * (1 - .5**num_layers)
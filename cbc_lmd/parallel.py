@@ -0,0 +1,265 @@
+import multiprocessing
+import random
+import traceback
+from array import array
+from multiprocessing.connection import Connection
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    NoReturn,
+    Optional,
+    Tuple,
+)
+
+from cbc_lmd.main import Block
+from cbc_lmd.message import (
+    Message,
+    Validator,
+)
+from cbc_lmd.persistent import PersistentMap
+
+GENESIS_ID = 0
+
+
+def block_id(sender: int, message_height: int, num_validators: int) -> int:
+    # every message makes a new block, so numbering blocks after their message numbers them all
+    # distinctly, the same way in every process
+    return message_height * num_validators + sender + 1
+
+
+class SimulatedBlock(Block):
+    # A block that hashes to its id. The fork choice breaks ties by the hash of the block, so this
+    # makes validators choose the same head in any process.
+    def __init__(self, parent_block: Optional[Block], block_id: int) -> None:
+        super().__init__(parent_block)
+        self.id = block_id
+
+    def __hash__(self) -> int:
+        return self.id
+
+
+def simulated(block: Block) -> SimulatedBlock:
+    # messages and trees keep their blocks as Blocks, but every block of a simulation is simulated
+    if not isinstance(block, SimulatedBlock):
+        raise Exception("Block {} is not a SimulatedBlock".format(block))
+    return block
+
+
+def encode_messages(messages: Iterable[Message]) -> bytes:
+    # each message as [sender, message height, id of the parent block, number of changed
+    # latest messages, then the sender and height of each]. Only the latest messages that changed
+    # since the sender's previous message are sent, as the receiver already has that message.
+    encoded = array('q')
+    for message in messages:
+        parent_block = simulated(message.block.parent_block)
+        encoded.extend((message.sender, message.message_height, parent_block.id))
+        if message.prev_message is not None:
+            changed = list(message.latest_messages.changed_items(message.prev_message.latest_messages))
+        else:
+            changed = list(message.latest_messages.items())
+        encoded.append(len(changed))
+        for sender, latest_message in changed:
+            encoded.extend((sender, latest_message.message_height))
+    return encoded.tobytes()
+
+
+class Shard:
+    # Some of the validators of a simulation, with every message and block made so far, as the
+    # validators' messages can depend on any of them
+    def __init__(self, names: List[int], num_validators: int, weight: Dict[int, int]) -> None:
+        self.num_validators = num_validators
+        genesis = SimulatedBlock(None, GENESIS_ID)
+        self.blocks = {GENESIS_ID: genesis}  # type: Dict[int, SimulatedBlock]
+        self.messages = dict()  # type: Dict[Tuple[int, int], Message]
+        self.validators = {name: Validator(name, genesis, weight) for name in names}
+
+    def decode_messages(self, encoded: bytes) -> List[Message]:
+        values = array('q')
+        values.frombytes(encoded)
+        decoded = []  # type: List[Message]
+        idx = 0
+        while idx < len(values):
+            sender, message_height, parent_id, num_changed = values[idx:idx + 4]
+            idx += 4
+            changed = dict()  # type: Dict[int, Message]
+            for _ in range(num_changed):
+                changed[values[idx]] = self.messages[(values[idx], values[idx + 1])]
+                idx += 2
+
+            message = self.messages.get((sender, message_height), None)
+            if message is None:
+                prev_message = self.messages.get((sender, message_height - 1), None)
+                latest_messages = PersistentMap() if prev_message is None else prev_message.latest_messages
+                block = SimulatedBlock(self.blocks[parent_id], block_id(sender, message_height, self.num_validators))
+                self.blocks[block.id] = block
+                message = Message(sender, block, latest_messages.update(changed), prev_message=prev_message)
+                self.messages[(sender, message_height)] = message
+            decoded.append(message)
+        return decoded
+
+    def step(self, encoded: bytes, deliveries: Dict[int, List[int]], makers: List[int]) -> bytes:
+        # take in the messages of the last round, have the validators see those delivered to them
+        # (given by their senders), then make the messages of the next round
+        new_messages = {message.sender: message for message in self.decode_messages(encoded)}
+        for name, senders in deliveries.items():
+            val = self.validators[name]
+            for sender in senders:
+                val.see_message(new_messages[sender])
+
+        made = []  # type: List[Message]
+        for name in makers:
+            val = self.validators[name]
+            new_id = block_id(name, len(val.own_message_at_height), self.num_validators)
+            message = val.make_new_message(lambda head: SimulatedBlock(head, new_id))
+            block = simulated(message.block)
+            self.blocks[block.id] = block
+            self.messages[(name, message.message_height)] = message
+            made.append(message)
+        return encode_messages(made)
+
+    def heads(self) -> Dict[int, int]:
+        return {name: simulated(val.forkchoice()).id for name, val in self.validators.items()}
+
+
+def run_shard(connection: Connection, names: List[int], num_validators: int, weight: Dict[int, int]) -> None:
+    # reply to each command with (True, result), or (False, the traceback) if it failed, after
+    # which the worker stops
+    try:
+        shard = Shard(names, num_validators, weight)
+        while True:
+            command = connection.recv()
+            if command is None:
+                break
+            if command[0] == 'step':
+                connection.send((True, shard.step(*command[1:])))
+            elif command[0] == 'heads':
+                connection.send((True, shard.heads()))
+    except Exception:
+        connection.send((False, traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ParallelSimulation:
+    # Validators making and seeing messages in rounds, sharded across worker processes. In each
+    # round, every validator makes a message with message_probability, and sees each message made
+    # in the round before with delivery_probability (a validator always sees its own). All random
+    # choices come from one generator here, and the workers only exchange encoded messages, so a
+    # seed gives the same run for any number of workers. With no workers, the validators are all
+    # simulated in this process.
+    def __init__(self,
+                 num_validators: int,
+                 num_workers: int=0,
+                 seed: int=0,
+                 weight: Optional[Dict[int, int]]=None,
+                 message_probability: float=1.0,
+                 delivery_probability: float=1.0) -> None:
+        if weight is None:
+            weight = {v: 1 for v in range(num_validators)}
+        self.num_validators = num_validators
+        self.rng = random.Random(seed)
+        self.message_probability = message_probability
+        self.delivery_probability = delivery_probability
+        self.shard_of = [name % max(1, num_workers) for name in range(num_validators)]
+        self.encoded = [b''] * max(1, num_workers)
+        # the validators that made a message in the last round
+        self.made = []  # type: List[int]
+        self.shards = []  # type: List[Shard]
+        self.connections = []  # type: List[Connection]
+        self.workers = []  # type: List[multiprocessing.Process]
+        if num_workers == 0:
+            self.shards.append(Shard(list(range(num_validators)), num_validators, weight))
+            return
+        for worker in range(num_workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(worker_connection, list(range(worker, num_validators, num_workers)), num_validators, weight),
+                daemon=True,
+            )
+            process.start()
+            # only the worker has this end open now, so recv raises EOFError if the worker exits
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(process)
+
+    def run(self, num_rounds: int) -> None:
+        for _ in range(num_rounds):
+            self.step()
+
+    def step(self) -> None:
+        # the messages of the last round, from all shards
+        encoded = b''.join(self.encoded)
+
+        deliveries = [dict() for _ in self.encoded]  # type: List[Dict[int, List[int]]]
+        makers = [[] for _ in self.encoded]  # type: List[List[int]]
+        made = []  # type: List[int]
+        for name in range(self.num_validators):
+            senders = [sender for sender in self.made if self.rng.random() < self.delivery_probability]
+            if len(senders) > 0:
+                deliveries[self.shard_of[name]][name] = senders
+            if self.rng.random() < self.message_probability:
+                makers[self.shard_of[name]].append(name)
+                made.append(name)
+
+        if len(self.shards) > 0:
+            self.encoded = [self.shards[0].step(encoded, deliveries[0], makers[0])]
+        else:
+            for shard in range(len(self.connections)):
+                self.send(shard, ('step', encoded, deliveries[shard], makers[shard]))
+            self.encoded = [self.receive(shard) for shard in range(len(self.connections))]
+        self.made = made
+
+    def heads(self) -> Dict[int, int]:
+        # the id of each validator's head block
+        if len(self.shards) > 0:
+            return self.shards[0].heads()
+        heads = dict()  # type: Dict[int, int]
+        for shard in range(len(self.connections)):
+            self.send(shard, ('heads',))
+        for shard in range(len(self.connections)):
+            heads.update(self.receive(shard))
+        return heads
+
+    def send(self, shard: int, command: Tuple) -> None:
+        try:
+            self.connections[shard].send(command)
+        except OSError:
+            self.worker_exited(shard)
+
+    def receive(self, shard: int) -> Any:
+        # the reply from a worker, raising if the worker failed or exited instead
+        try:
+            ok, result = self.connections[shard].recv()
+        except EOFError:
+            self.worker_exited(shard)
+        if not ok:
+            raise Exception("Worker {} failed:\n{}".format(shard, result))
+        return result
+
+    def worker_exited(self, shard: int) -> NoReturn:
+        self.workers[shard].join()
+        raise Exception("Worker {} exited with code {}".format(shard, self.workers[shard].exitcode))
+
+    def close(self) -> None:
+        for connection, process in zip(self.connections, self.workers):
+            # a worker that failed has already closed its end
+            if process.is_alive():
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+            connection.close()
+        for process in self.workers:
+            process.join()
+        self.connections = []
+        self.workers = []
+
+    def __enter__(self) -> 'ParallelSimulation':
+        return self
+
+    def __exit__(self, *args: Optional[object]) -> None:
+        self.close()
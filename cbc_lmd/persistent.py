@@ -0,0 +1,249 @@
+import sys
+
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+# each level of the trie uses 5 bits of the key's hash, so has up to 32 entries
+BITS_PER_LEVEL = 5
+LEVEL_MASK = (1 << BITS_PER_LEVEL) - 1
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+_MISSING = object()
+
+
+def _key_hash(key: Hashable) -> int:
+    return hash(key) & HASH_MASK
+
+
+def _popcount(bits: int) -> int:
+    return bin(bits).count('1')
+
+
+if sys.version_info >= (3, 10):
+    # much faster, where python has it
+    def _popcount(bits: int) -> int:  # noqa: F811
+        return bits.bit_count()
+
+
+class _TrieNode:
+    # A node of the trie. It only stores the entries it has, in order, and which of its 32 slots
+    # they are in is given by the set bits of the bitmap. An entry is a (key, value) pair, or a
+    # _TrieNode for the keys whose hashes share the bits so far.
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap: int, entries: Tuple[Any, ...]) -> None:
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _CollisionNode:
+    # keys whose hashes are entirely equal
+    __slots__ = ('key_hash', 'entries')
+
+    def __init__(self, key_hash: int, entries: Tuple[Tuple[Hashable, Any], ...]) -> None:
+        self.key_hash = key_hash
+        self.entries = entries
+
+
+_Node = Union[_TrieNode, _CollisionNode]
+
+
+def _pair_node(pair_1: Tuple[Hashable, Any], hash_1: int,
+               pair_2: Tuple[Hashable, Any], hash_2: int, shift: int) -> _Node:
+    # a node holding two pairs whose hashes match below shift
+    if hash_1 == hash_2:
+        return _CollisionNode(hash_1, (pair_1, pair_2))
+    slot_1 = (hash_1 >> shift) & LEVEL_MASK
+    slot_2 = (hash_2 >> shift) & LEVEL_MASK
+    if slot_1 == slot_2:
+        return _TrieNode(1 << slot_1, (_pair_node(pair_1, hash_1, pair_2, hash_2, shift + BITS_PER_LEVEL),))
+    if slot_1 < slot_2:
+        return _TrieNode((1 << slot_1) | (1 << slot_2), (pair_1, pair_2))
+    return _TrieNode((1 << slot_1) | (1 << slot_2), (pair_2, pair_1))
+
+
+def _set(node: _Node, key_hash: int, shift: int, key: Hashable, value: Any) -> Tuple[_Node, bool]:
+    # returns a copy of the node with the key set, and whether the key is new. Only the nodes on
+    # the path to the key are copied, the rest are shared with the old node.
+    if isinstance(node, _CollisionNode):
+        for idx, (other_key, other_value) in enumerate(node.entries):
+            if other_key == key:
+                if other_value is value:
+                    return node, False
+                entries = node.entries[:idx] + ((key, value),) + node.entries[idx + 1:]
+                return _CollisionNode(node.key_hash, entries), False
+        return _CollisionNode(node.key_hash, node.entries + ((key, value),)), True
+
+    bit = 1 << ((key_hash >> shift) & LEVEL_MASK)
+    idx = _popcount(node.bitmap & (bit - 1))
+    if not node.bitmap & bit:
+        entries = node.entries[:idx] + ((key, value),) + node.entries[idx:]
+        return _TrieNode(node.bitmap | bit, entries), True
+
+    entry = node.entries[idx]
+    if isinstance(entry, tuple):
+        if entry[0] == key:
+            if entry[1] is value:
+                return node, False
+            new_entry = (key, value)  # type: Any
+            added = False
+        else:
+            new_entry = _pair_node(entry, _key_hash(entry[0]), (key, value), key_hash, shift + BITS_PER_LEVEL)
+            added = True
+    else:
+        new_entry, added = _set(entry, key_hash, shift + BITS_PER_LEVEL, key, value)
+        if new_entry is entry:
+            return node, False
+    return _TrieNode(node.bitmap, node.entries[:idx] + (new_entry,) + node.entries[idx + 1:]), added
+
+
+class PersistentMap(Mapping):
+    # An immutable map (a hash array mapped trie) that can be "changed" in O(log n) by making a
+    # new map. The new map shares everything but the path to the changed key with the old one,
+    # so keeping many versions of a map costs little more than keeping one.
+    __slots__ = ('root', 'size')
+
+    def __init__(self, items: Optional[Mapping]=None) -> None:
+        self.root = _TrieNode(0, ())  # type: _Node
+        self.size = 0
+        if items is not None:
+            for key, value in items.items():
+                self.root, added = _set(self.root, _key_hash(key), 0, key, value)
+                self.size += added
+
+    def set(self, key: Hashable, value: Any) -> 'PersistentMap':
+        root, added = _set(self.root, _key_hash(key), 0, key, value)
+        if root is self.root:
+            return self
+        new_map = PersistentMap()
+        new_map.root = root
+        new_map.size = self.size + added
+        return new_map
+
+    def update(self, items: Mapping) -> 'PersistentMap':
+        root = self.root
+        size = self.size
+        for key, value in items.items():
+            root, added = _set(root, _key_hash(key), 0, key, value)
+            size += added
+        if root is self.root:
+            return self
+        new_map = PersistentMap()
+        new_map.root = root
+        new_map.size = size
+        return new_map
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        key_hash = _key_hash(key)
+        node = self.root
+        shift = 0
+        while True:
+            if isinstance(node, _CollisionNode):
+                for other_key, value in node.entries:
+                    if other_key == key:
+                        return value
+                return default
+            bit = 1 << ((key_hash >> shift) & LEVEL_MASK)
+            if not node.bitmap & bit:
+                return default
+            entry = node.entries[_popcount(node.bitmap & (bit - 1))]
+            if isinstance(entry, tuple):
+                return entry[1] if entry[0] == key else default
+            node = entry
+            shift += BITS_PER_LEVEL
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return self.size
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:  # type: ignore
+        return PersistentMap._items_below(self.root)
+
+    @staticmethod
+    def _items_below(node: _Node) -> Iterator[Tuple[Any, Any]]:
+        stack = [node]  # type: List[_Node]
+        while len(stack) > 0:
+            node = stack.pop()
+            for entry in node.entries:
+                if isinstance(entry, tuple):
+                    yield entry
+                else:
+                    stack.append(entry)
+
+    def __iter__(self) -> Iterator[Any]:
+        for key, _ in self.items():
+            yield key
+
+    def values(self) -> Iterator[Any]:  # type: ignore
+        for _, value in self.items():
+            yield value
+
+    def changed_items(self, other: 'PersistentMap') -> Iterator[Tuple[Any, Any]]:
+        # the items of this map that are not in the other map, or have a different value there.
+        # Parts of the trie the maps share are skipped, so comparing a map with the one it was
+        # made from only visits the paths to the keys that changed.
+        stack = [(self.root, other.root)]  # type: List[Tuple[_Node, Any]]
+        while len(stack) > 0:
+            node, other_node = stack.pop()
+            if node is other_node:
+                continue
+            if isinstance(node, _CollisionNode):
+                for key, value in node.entries:
+                    if other.get(key, _MISSING) is not value:
+                        yield key, value
+                continue
+
+            if not isinstance(other_node, _TrieNode):
+                # the tries differ in shape here, so look the keys up in the other map
+                for key, value in PersistentMap._items_below(node):
+                    if other.get(key, _MISSING) is not value:
+                        yield key, value
+                continue
+
+            # visit the set bits of the bitmap, lowest first, which is the order of the entries
+            bits = node.bitmap
+            for entry in node.entries:
+                bit = bits & -bits
+                bits ^= bit
+                if not other_node.bitmap & bit:
+                    # nothing in the other map has a hash that ends in the same bits
+                    if isinstance(entry, tuple):
+                        yield entry
+                    else:
+                        yield from PersistentMap._items_below(entry)
+                    continue
+                other_entry = other_node.entries[_popcount(other_node.bitmap & (bit - 1))]
+                if entry is other_entry:
+                    continue
+                if isinstance(entry, tuple) and isinstance(other_entry, tuple):
+                    if entry[0] != other_entry[0] or entry[1] is not other_entry[1]:
+                        yield entry
+                elif isinstance(entry, tuple):
+                    if other.get(entry[0], _MISSING) is not entry[1]:
+                        yield entry
+                else:
+                    stack.append((entry, other_entry))
+
+    def to_dict(self) -> Dict[Hashable, Any]:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return "PersistentMap({})".format(self.to_dict())
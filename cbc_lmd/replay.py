@@ -0,0 +1,246 @@
+import argparse
+import json
+import random
+import time
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from cbc_lmd.message import (
+    Message,
+    Validator,
+)
+from cbc_lmd.network import percentile
+from cbc_lmd.main import Block
+from cbc_lmd.parallel import (
+    SimulatedBlock,
+    simulated,
+)
+from cbc_lmd.persistent import PersistentMap
+from cbc_lmd.trace import (
+    GENESIS_ID,
+    NO_MESSAGE,
+    TraceMessage,
+    TraceRecord,
+    TraceWeight,
+    read_trace,
+)
+
+# the number of latencies each stage keeps a sample of, for its percentiles
+MAX_SAMPLES = 10000
+# the name of the validator replaying the trace, which never sends messages
+OBSERVER = -1
+
+
+class Stage:
+    # A step of the pipeline, timing only the time spent in its own step, and not in the stages
+    # before it. The latencies are a uniform sample of the time taken for each item, so they take
+    # bounded memory however long the trace is.
+    def __init__(self, name: str, items: Iterator, upstream: Optional['Stage']=None) -> None:
+        self.name = name
+        self.items = items
+        self.upstream = upstream
+        self.count = 0
+        # the time spent in this stage, and with the stages before it
+        self.seconds = 0.0
+        self.total_seconds = 0.0
+        self.samples = []  # type: List[float]
+        self.rng = random.Random(0)
+
+    def __iter__(self) -> 'Stage':
+        return self
+
+    def __next__(self) -> Any:
+        upstream_before = 0.0 if self.upstream is None else self.upstream.total_seconds
+        start = time.perf_counter()
+        try:
+            item = next(self.items)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.total_seconds += elapsed
+            own = elapsed - (0.0 if self.upstream is None else self.upstream.total_seconds - upstream_before)
+            self.seconds += own
+        self.count += 1
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(own)
+        else:
+            idx = self.rng.randrange(self.count)
+            if idx < MAX_SAMPLES:
+                self.samples[idx] = own
+        return item
+
+    def report(self) -> Dict[str, float]:
+        return {
+            'items': self.count,
+            'seconds': self.seconds,
+            'items_per_second': self.count / self.seconds if self.seconds > 0 else 0.0,
+            'p50_us': percentile(self.samples, 50) * 1e6,
+            'p99_us': percentile(self.samples, 99) * 1e6,
+            'max_us': max(self.samples, default=0.0) * 1e6,
+        }
+
+
+def in_dependency_order(records: Iterator[TraceRecord], max_pending: int) -> Iterator[TraceRecord]:
+    # messages can be recorded before messages they depend on (their previous message, latest
+    # messages and the parent of their block), so hold them back until those have been seen. At
+    # most max_pending messages are held back at once.
+    seen_messages = set()  # type: Set[int]
+    seen_blocks = {GENESIS_ID}  # type: Set[int]
+    # the messages waiting for each message or block
+    waiting_for_message = dict()  # type: Dict[int, List[TraceMessage]]
+    waiting_for_block = dict()  # type: Dict[int, List[TraceMessage]]
+    num_pending = 0
+
+    def wait_for_missing(record: TraceMessage) -> bool:
+        if record.parent_id not in seen_blocks:
+            waiting_for_block.setdefault(record.parent_id, []).append(record)
+            return True
+        if record.prev_id != NO_MESSAGE and record.prev_id not in seen_messages:
+            waiting_for_message.setdefault(record.prev_id, []).append(record)
+            return True
+        for _, message_id in record.latest_messages:
+            if message_id not in seen_messages:
+                waiting_for_message.setdefault(message_id, []).append(record)
+                return True
+        return False
+
+    for record in records:
+        if isinstance(record, TraceWeight):
+            yield record
+            continue
+        if wait_for_missing(record):
+            num_pending += 1
+            if num_pending > max_pending:
+                raise Exception("More than {} messages are waiting for messages they depend on".format(max_pending))
+            continue
+        ready = [record]
+        while len(ready) > 0:
+            message = ready.pop()
+            yield message
+            seen_messages.add(message.message_id)
+            seen_blocks.add(message.block_id)
+            # the messages waiting for this one may now be waiting for something else
+            released = waiting_for_message.pop(message.message_id, []) + waiting_for_block.pop(message.block_id, [])
+            for waiting in released:
+                num_pending -= 1
+                if wait_for_missing(waiting):
+                    num_pending += 1
+                else:
+                    ready.append(waiting)
+
+    if num_pending > 0:
+        raise Exception("{} messages depend on messages that are not in the trace".format(num_pending))
+
+
+class Replay:
+    # Replays a trace into a validator that only observes, through a pipeline of generators, so
+    # the trace is never read in at once. The blocks and messages built from it are all kept, as a
+    # later message can build on any block and refer to any message, and the validator keeps them
+    # all in its justification anyway. So memory grows with the number of messages replayed, and
+    # only the stages' latency samples are bounded.
+    def __init__(self, max_pending: int=100000, fork_choice_every: int=1) -> None:
+        self.max_pending = max_pending
+        self.fork_choice_every = fork_choice_every
+        self.genesis = SimulatedBlock(None, GENESIS_ID)
+        self.blocks = {GENESIS_ID: self.genesis}  # type: Dict[int, SimulatedBlock]
+        self.messages = dict()  # type: Dict[int, Message]
+        self.weight = dict()  # type: Dict[int, int]
+        self.validator = None  # type: Optional[Validator]
+        self.stages = []  # type: List[Stage]
+
+    def build_messages(self, records: Iterator[TraceRecord]) -> Iterator[Message]:
+        for record in records:
+            if isinstance(record, TraceWeight):
+                self.weight[record.validator] = record.weight
+                if self.validator is not None:
+                    self.validator.tree.set_validator_weight(record.validator, record.weight)
+                continue
+            block = self.blocks.get(record.block_id, None)
+            if block is None:
+                block = SimulatedBlock(self.blocks[record.parent_id], record.block_id)
+                self.blocks[record.block_id] = block
+            changed = {sender: self.messages[message_id] for sender, message_id in record.latest_messages}
+            prev_message = None if record.prev_id == NO_MESSAGE else self.messages[record.prev_id]
+            if prev_message is None:
+                latest_messages = PersistentMap(changed)
+            else:
+                latest_messages = prev_message.latest_messages.update(changed)
+            message = Message(record.sender, block, latest_messages, prev_message=prev_message)
+            self.messages[record.message_id] = message
+            yield message
+
+    def see_messages(self, messages: Iterator[Message]) -> Iterator[Message]:
+        for message in messages:
+            if self.validator is None:
+                self.validator = Validator(OBSERVER, self.genesis, self.weight)
+            self.validator.see_message(message)
+            yield message
+
+    def fork_choice(self, messages: Iterator[Message]) -> Iterator[Optional[Block]]:
+        for idx, message in enumerate(messages):
+            if self.validator is not None and idx % self.fork_choice_every == self.fork_choice_every - 1:
+                yield self.validator.forkchoice()
+            else:
+                yield None
+
+    def pipeline(self, records: Iterator[TraceRecord]) -> Stage:
+        steps = [
+            ('decode', lambda items: items),
+            ('order', lambda items: in_dependency_order(items, self.max_pending)),
+            ('build', self.build_messages),
+            ('see_message', self.see_messages),
+            ('fork_choice', self.fork_choice),
+        ]  # type: List[Tuple[str, Callable[[Iterator], Iterator]]]
+        stage = None  # type: Optional[Stage]
+        items = records  # type: Iterator
+        for name, step in steps:
+            stage = Stage(name, step(items), stage)
+            self.stages.append(stage)
+            items = stage
+        return stage  # type: ignore
+
+    def run(self, path: str) -> Dict[str, Any]:
+        start = time.perf_counter()
+        for _ in self.pipeline(read_trace(path)):
+            pass
+        elapsed = time.perf_counter() - start
+        head = self.genesis if self.validator is None else simulated(self.validator.forkchoice())
+        return {
+            'messages': len(self.messages),
+            'seconds': elapsed,
+            'messages_per_second': len(self.messages) / elapsed if elapsed > 0 else 0.0,
+            'head': head.id,
+            'head_height': head.height,
+            'stages': {stage.name: stage.report() for stage in self.stages},
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded message trace, timing each stage")
+    parser.add_argument('trace', type=str)
+    parser.add_argument('--fork-choice-every', type=int, default=1, help="run the fork choice every this many messages")
+    parser.add_argument('--max-pending', type=int, default=100000,
+                        help="the most messages to hold back waiting for their dependencies")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = Replay(args.max_pending, args.fork_choice_every).run(args.trace)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("{} messages in {:.2f}s ({:.0f}/s), head {} at height {}".format(
+            report['messages'], report['seconds'], report['messages_per_second'], report['head'],
+            report['head_height'],
+        ))
+        for name, stage in report['stages'].items():
+            print("{:<12}{:>10} items {:>12.0f}/s  p50 {:>8.1f}us  p99 {:>8.1f}us  max {:>10.1f}us".format(
+                name, stage['items'], stage['items_per_second'], stage['p50_us'], stage['p99_us'], stage['max_us']
+            ))
@@ -0,0 +1,233 @@
+import mmap
+import struct
+import sys
+from array import array
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from cbc_lmd.block_store import (
+    BlockStore,
+    StoredBlock,
+    as_block,
+    as_stored_block,
+)
+from cbc_lmd.main import (
+    CompressedTree,
+    Node,
+)
+
+MAGIC = b'CBCSNAP\0'
+SNAPSHOT_VERSION = 1
+NO_NODE = -1
+# the flags of the header: whether there is a tree, and whether the tree has an LCA index
+HAS_TREE = 1
+HAS_LCA_INDEX = 2
+# magic, version, flags, then the number of blocks, skip pointers, nodes, validators with latest
+# blocks, validator weights and path blocks, the root node and the tree's node counter
+HEADER = struct.Struct('<8sII8q')
+ALIGNMENT = 8
+
+
+def padding(length: int) -> bytes:
+    return b'\0' * (-length % ALIGNMENT)
+
+
+def write_snapshot(path: str, store: BlockStore, tree: Optional[CompressedTree]=None) -> None:
+    # The snapshot is the header, then each array of the store and the tree in turn, little endian
+    # like the header and aligned to 8 bytes, so they can be read straight from the file.
+    # The tree's blocks must all be in the store. A tree's LCA index is not written, only whether
+    # it has one, and it is rebuilt from the tree's blocks when loaded.
+    nodes = [] if tree is None else list(tree.all_nodes())
+    node_idx = {node: idx for idx, node in enumerate(nodes)}  # type: Dict[Node, int]
+
+    sections = [store.heights, store.parents, store.names, store.skip_offsets, store.skips]  # type: List[array]
+    num_validators = num_weights = num_path_blocks = 0
+    root = node_counter = NO_NODE
+    flags = 0
+    if tree is not None:
+        flags |= HAS_TREE
+        if tree.lca_index is not None:
+            flags |= HAS_LCA_INDEX
+        sections.extend([
+            array('q', [as_stored_block(node.block).index for node in nodes]),
+            array('q', [NO_NODE if node.parent is None else node_idx[node.parent] for node in nodes]),
+            array('q', [node.has_weight for node in nodes]),
+            array('q', [node.weight for node in nodes]),
+            array('q', [node.score for node in nodes]),
+            array('q', tree.latest_block_nodes.keys()),
+            array('q', [NO_NODE if node is None else node_idx[node] for node in tree.latest_block_nodes.values()]),
+            array('q', tree.weight.keys()),
+            array('q', tree.weight.values()),
+            array('q', [as_stored_block(block).index for block in tree.path_block_to_child_node]),
+            array('q', [node_idx[node] for node in tree.path_block_to_child_node.values()]),
+        ])
+        num_validators = len(tree.latest_block_nodes)
+        num_weights = len(tree.weight)
+        num_path_blocks = len(tree.path_block_to_child_node)
+        root = node_idx[tree.root]
+        node_counter = tree.node_counter
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, SNAPSHOT_VERSION, flags,
+            len(store), len(store.skips), len(nodes), num_validators, num_weights, num_path_blocks, root, node_counter,
+        ))
+        for section in sections:
+            if sys.byteorder != 'little':
+                section = array(section.typecode, section)
+                section.byteswap()
+            data = section.tobytes()
+            f.write(data)
+            f.write(padding(len(data)))
+
+
+class MappedBlockStore(BlockStore):
+    # A BlockStore whose arrays are views of a snapshot file, so its blocks are read from the file
+    # as they are needed. The arrays are only copied into memory when a block is added.
+    def __init__(self, mapped: mmap.mmap, sections: List[Tuple[str, memoryview]]) -> None:
+        self.mapped = mapped  # type: Optional[mmap.mmap]
+        self.views = sections
+        # read in place, as memoryviews of the file rather than arrays
+        self.heights, self.parents, self.names, self.skip_offsets, self.skips = [
+            view.cast(typecode) for typecode, view in sections  # type: ignore
+        ]
+
+    def add(self, parent: int=-1, name: int=0) -> int:
+        if self.mapped is not None:
+            self.copy_into_memory()
+        return super().add(parent, name)
+
+    def copy_into_memory(self) -> None:
+        copies = []
+        for typecode, view in self.views:
+            copy = array(typecode)
+            copy.frombytes(view)
+            copies.append(copy)
+        self.close()
+        self.heights, self.parents, self.names, self.skip_offsets, self.skips = copies
+
+    def close(self) -> None:
+        # the views of the file have to be released before it can be closed
+        for array_view in [self.heights, self.parents, self.names, self.skip_offsets, self.skips]:
+            if isinstance(array_view, memoryview):
+                array_view.release()
+        for _, view in self.views:
+            view.release()
+        self.views = []
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+def load_snapshot(path: str) -> Tuple[BlockStore, Optional[CompressedTree]]:
+    if sys.byteorder != 'little':
+        raise Exception("Snapshots can only be loaded on little endian machines")
+    with open(path, 'rb') as f:
+        # mapped copy on write, as the tree sets the names of blocks, but the file is never changed
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    (magic, version, flags, num_blocks, num_skips, num_nodes, num_validators, num_weights, num_path_blocks,
+     root, node_counter) = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise Exception("{} is not a snapshot".format(path))
+    if version != SNAPSHOT_VERSION:
+        raise Exception("Snapshot {} has version {}, but only version {} can be loaded".format(
+            path, version, SNAPSHOT_VERSION
+        ))
+
+    whole_file = memoryview(mapped)
+    offset = HEADER.size
+    sections = []  # type: List[Tuple[str, memoryview]]
+
+    def next_section(typecode: str, length: int) -> memoryview:
+        nonlocal offset
+        size = array(typecode).itemsize * length
+        view = whole_file[offset:offset + size]
+        offset += size + len(padding(size))
+        sections.append((typecode, view))
+        return view
+
+    for typecode, length in [('i', num_blocks), ('i', num_blocks), ('q', num_blocks), ('q', num_blocks + 1),
+                             ('i', num_skips)]:
+        next_section(typecode, length)
+    store = MappedBlockStore(mapped, sections)
+    if not flags & HAS_TREE:
+        whole_file.release()
+        return store, None
+
+    tree_sections = [
+        next_section('q', length).cast('q')
+        for length in [num_nodes] * 5 + [num_validators] * 2 + [num_weights] * 2 + [num_path_blocks] * 2
+    ]
+    # only the store's views are kept, as the tree's are read here once
+    del sections[5:]
+    tree = load_tree(store, bool(flags & HAS_LCA_INDEX), root, node_counter, *tree_sections)
+    for view in tree_sections:
+        view.release()
+    whole_file.release()
+    return store, tree
+
+
+def load_tree(store: BlockStore,
+              use_lca_index: bool,
+              root: int,
+              node_counter: int,
+              node_blocks: memoryview,
+              node_parents: memoryview,
+              node_has_weight: memoryview,
+              node_weights: memoryview,
+              node_scores: memoryview,
+              validators: memoryview,
+              latest_nodes: memoryview,
+              weight_validators: memoryview,
+              weights: memoryview,
+              path_blocks: memoryview,
+              path_nodes: memoryview) -> CompressedTree:
+    # the tree's indexes are filled in from the nodes directly, rather than by adding them
+    root_block = as_block(StoredBlock(store=store, index=node_blocks[root]))
+    tree = CompressedTree(root_block, dict(zip(weight_validators, weights)), use_lca_index=use_lca_index)
+    nodes = []  # type: List[Node]
+    for idx in range(len(node_blocks)):
+        if idx == root:
+            node = tree.root
+            node.has_weight = bool(node_has_weight[idx])
+        else:
+            node = Node(as_block(StoredBlock(store=store, index=node_blocks[idx])), None, bool(node_has_weight[idx]))
+        node.weight = node_weights[idx]
+        node.score = node_scores[idx]
+        nodes.append(node)
+
+    for idx, node in enumerate(nodes):
+        if idx == root:
+            continue
+        parent = nodes[node_parents[idx]]
+        node.parent = parent
+        parent.children.add(node)
+        block = node.block
+        tree.node_with_block[block] = node
+        tree.add_to_dfs_order(block)
+        if block.height not in tree.blocks_at_height:
+            tree.blocks_at_height[block.height] = set()
+            tree.heights.add(block.height)
+        tree.blocks_at_height[block.height].add(block)
+        if tree.lca_index is not None:
+            # adds the blocks between the node and its parent too
+            tree.lca_index.add(block)
+
+    for validator, node_idx in zip(validators, latest_nodes):
+        if node_idx == NO_NODE:
+            tree.latest_block_nodes[validator] = None
+        else:
+            tree.latest_block_nodes[validator] = nodes[node_idx]
+            nodes[node_idx].validators.add(validator)
+    for block_idx, node_idx in zip(path_blocks, path_nodes):
+        tree.path_block_to_child_node[as_block(StoredBlock(store=store, index=block_idx))] = nodes[node_idx]
+
+    tree.node_counter = node_counter
+    tree.version += 1
+    tree.reset_head_path()
+    return tree
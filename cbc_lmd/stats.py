@@ -0,0 +1,139 @@
+import functools
+import time
+
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+# the operations timed while timers are on, as (module, class, method)
+TIMED_METHODS = [
+    ('cbc_lmd.main', 'Block', 'prev_at_height'),
+    ('cbc_lmd.main', 'CompressedTree', 'add_new_latest_block'),
+    ('cbc_lmd.main', 'CompressedTree', 'add_new_latest_blocks'),
+    ('cbc_lmd.main', 'CompressedTree', 'add_block_with_weight'),
+    ('cbc_lmd.main', 'CompressedTree', 'find_prev_node_in_tree'),
+    ('cbc_lmd.main', 'CompressedTree', 'find_head'),
+    ('cbc_lmd.main', 'CompressedTree', 'prune'),
+]
+
+
+class Stats:
+    # Counters and timers for the hot paths, off by default. While off, the counters cost the hot
+    # paths one check of enabled, and the timers nothing, as they are only wrapped around the
+    # methods while on.
+    def __init__(self) -> None:
+        self.enabled = False
+        self.counters = dict()  # type: Dict[str, int]
+        # the number of calls, the total and the max time of each timed operation
+        self.timers = dict()  # type: Dict[str, List[float]]
+        self.unwrapped = dict()  # type: Dict[Tuple[type, str], Callable]
+        self.dump_hook = None  # type: Optional[Callable[[Dict[str, Any]], None]]
+        self.dump_interval = 0.0
+        self.next_dump = 0.0
+
+    def enable(self, timers: bool=True) -> None:
+        self.enabled = True
+        if timers:
+            self.wrap_timed_methods()
+
+    def disable(self) -> None:
+        self.enabled = False
+        for (cls, name), method in self.unwrapped.items():
+            setattr(cls, name, method)
+        self.unwrapped = dict()
+
+    def reset(self) -> None:
+        self.counters = dict()
+        self.timers = dict()
+
+    def count(self, name: str, amount: int=1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+        if self.dump_hook is not None:
+            self.maybe_dump()
+
+    def record_time(self, name: str, seconds: float) -> None:
+        timer = self.timers.get(name, None)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+        if self.dump_hook is not None:
+            self.maybe_dump()
+
+    def wrap_timed_methods(self) -> None:
+        for module_name, class_name, method_name in TIMED_METHODS:
+            module = __import__(module_name, fromlist=[class_name])
+            cls = getattr(module, class_name)
+            if (cls, method_name) in self.unwrapped:
+                continue
+            method = cls.__dict__[method_name]
+            self.unwrapped[(cls, method_name)] = method
+            setattr(cls, method_name, self.timed(method, '{}.{}'.format(class_name, method_name)))
+
+    def timed(self, method: Callable, name: str) -> Callable:
+        @functools.wraps(method)
+        def timed_method(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record_time(name, time.perf_counter() - start)
+        return timed_method
+
+    def set_dump_hook(self, hook: Optional[Callable[[Dict[str, Any]], None]], interval: float=60.0) -> None:
+        # call the hook with a snapshot of the stats at most every interval seconds, as they are
+        # recorded
+        self.dump_hook = hook
+        self.dump_interval = interval
+        self.next_dump = time.monotonic() + interval
+
+    def maybe_dump(self) -> None:
+        now = time.monotonic()
+        if now >= self.next_dump and self.dump_hook is not None:
+            self.next_dump = now + self.dump_interval
+            self.dump_hook(self.snapshot())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'counters': dict(self.counters),
+            'timers': {
+                name: {
+                    'calls': int(calls),
+                    'total_s': total,
+                    'mean_s': total / calls,
+                    'max_s': max_time,
+                }
+                for name, (calls, total, max_time) in self.timers.items()
+            },
+        }
+
+
+STATS = Stats()
+
+
+def tree_shape(tree: Any) -> Dict[str, int]:
+    # the shape of a CompressedTree, to go along with its stats
+    depth = 0
+    num_leaves = 0
+    stack = [(tree.root, 0)]
+    while len(stack) > 0:
+        node, node_depth = stack.pop()
+        depth = max(depth, node_depth)
+        if len(node.children) == 0:
+            num_leaves += 1
+        stack.extend((child, node_depth + 1) for child in node.children)
+    return {
+        'size': tree.size,
+        'leaves': num_leaves,
+        'depth': depth,
+        'heights': len(tree.heights),
+        'root_height': tree.root.block.height,
+    }
@@ -0,0 +1,189 @@
+import struct
+from array import array
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+
+from cbc_lmd.main import Block
+from cbc_lmd.message import Message
+
+# A trace is the messages a validator saw, in the order it saw them, and the weights of the
+# validators. Messages, validators and blocks are referred to by id, the genesis block has id
+# GENESIS_ID, and messages only list the latest messages that changed since the sender's previous
+# message. In the line format, each line is one of
+#   m <id> <sender> <block id> <parent block id> <previous message id> [<sender>:<message id> ...]
+#   w <validator> <weight>
+# with NO_MESSAGE as the previous message id of a sender's first message, and lines starting with
+# a # ignored. The binary format is BINARY_MAGIC, then each record as little endian int64s, in the
+# same order as the line format, with a message's latest messages after the number of them.
+GENESIS_ID = 0
+NO_MESSAGE = -1
+BINARY_MAGIC = b'CBCTRACE'
+MESSAGE_RECORD = 0
+WEIGHT_RECORD = 1
+MESSAGE_STRUCT = struct.Struct('<6q')
+WEIGHT_STRUCT = struct.Struct('<2q')
+KIND_STRUCT = struct.Struct('<q')
+
+
+class TraceMessage:
+    __slots__ = ['message_id', 'sender', 'block_id', 'parent_id', 'prev_id', 'latest_messages']
+
+    def __init__(self,
+                 message_id: int,
+                 sender: int,
+                 block_id: int,
+                 parent_id: int,
+                 prev_id: int,
+                 latest_messages: List[Tuple[int, int]]) -> None:
+        self.message_id = message_id
+        self.sender = sender
+        self.block_id = block_id
+        self.parent_id = parent_id
+        self.prev_id = prev_id
+        # (sender, message id) of the latest messages that changed since the previous message
+        self.latest_messages = latest_messages
+
+
+class TraceWeight:
+    __slots__ = ['validator', 'weight']
+
+    def __init__(self, validator: int, weight: int) -> None:
+        self.validator = validator
+        self.weight = weight
+
+
+TraceRecord = Union[TraceMessage, TraceWeight]
+
+
+def decode_line(line: str) -> TraceRecord:
+    fields = line.split()
+    if fields[0] == 'm':
+        latest_messages = []  # type: List[Tuple[int, int]]
+        for pair in fields[6:]:
+            sender, message_id = pair.split(':')
+            latest_messages.append((int(sender), int(message_id)))
+        return TraceMessage(int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]),
+                            latest_messages)
+    if fields[0] == 'w':
+        return TraceWeight(int(fields[1]), int(fields[2]))
+    raise Exception("Unknown trace record {}".format(line))
+
+
+def encode_line(record: TraceRecord) -> str:
+    if isinstance(record, TraceWeight):
+        return 'w {} {}\n'.format(record.validator, record.weight)
+    return 'm {} {} {} {} {}{}\n'.format(
+        record.message_id, record.sender, record.block_id, record.parent_id, record.prev_id,
+        ''.join(' {}:{}'.format(sender, message_id) for sender, message_id in record.latest_messages)
+    )
+
+
+def encode_binary(record: TraceRecord) -> bytes:
+    if isinstance(record, TraceWeight):
+        return KIND_STRUCT.pack(WEIGHT_RECORD) + WEIGHT_STRUCT.pack(record.validator, record.weight)
+    latest_messages = array('q')
+    for sender, message_id in record.latest_messages:
+        latest_messages.append(sender)
+        latest_messages.append(message_id)
+    return KIND_STRUCT.pack(MESSAGE_RECORD) + MESSAGE_STRUCT.pack(
+        record.message_id, record.sender, record.block_id, record.parent_id, record.prev_id,
+        len(record.latest_messages)
+    ) + latest_messages.tobytes()
+
+
+def read_trace(path: str) -> Iterator[TraceRecord]:
+    # stream the records of a trace in either format, so it is never read into memory at once
+    with open(path, 'rb') as f:
+        binary = f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+        if not binary:
+            f.seek(0)
+            for raw_line in f:
+                line = raw_line.decode().strip()
+                if len(line) > 0 and not line.startswith('#'):
+                    yield decode_line(line)
+            return
+
+        while True:
+            kind_bytes = f.read(KIND_STRUCT.size)
+            if len(kind_bytes) == 0:
+                return
+            kind, = KIND_STRUCT.unpack(kind_bytes)
+            if kind == WEIGHT_RECORD:
+                validator, weight = WEIGHT_STRUCT.unpack(f.read(WEIGHT_STRUCT.size))
+                yield TraceWeight(validator, weight)
+            elif kind == MESSAGE_RECORD:
+                message_id, sender, block_id, parent_id, prev_id, num_latest = MESSAGE_STRUCT.unpack(
+                    f.read(MESSAGE_STRUCT.size)
+                )
+                values = array('q')
+                values.frombytes(f.read(16 * num_latest))
+                yield TraceMessage(message_id, sender, block_id, parent_id, prev_id,
+                                   list(zip(values[::2], values[1::2])))
+            else:
+                raise Exception("Unknown trace record kind {} in {}".format(kind, path))
+
+
+class TraceWriter:
+    # Writes messages to a trace, giving their blocks and them ids as they are first written. The
+    # messages in the justification of a message must be written before it.
+    def __init__(self, path: str, genesis: Block, binary: bool=False) -> None:
+        self.binary = binary
+        self.file = open(path, 'wb')
+        if binary:
+            self.file.write(BINARY_MAGIC)
+        self.block_ids = {genesis: GENESIS_ID}  # type: Dict[Block, int]
+        self.message_ids = dict()  # type: Dict[Message, int]
+
+    def write(self, record: TraceRecord) -> None:
+        self.file.write(encode_binary(record) if self.binary else encode_line(record).encode())
+
+    def write_weights(self, weight: Dict[int, int]) -> None:
+        for validator, validator_weight in weight.items():
+            self.write(TraceWeight(validator, validator_weight))
+
+    def block_id(self, block: Block) -> int:
+        block_id = self.block_ids.get(block, None)
+        if block_id is None:
+            block_id = len(self.block_ids)
+            self.block_ids[block] = block_id
+        return block_id
+
+    def write_message(self, message: Message) -> None:
+        if message in self.message_ids:
+            return
+        prev_message = message.prev_message
+        if prev_message is None:
+            changed = message.latest_messages.items()
+        else:
+            changed = message.latest_messages.changed_items(prev_message.latest_messages)
+        message_id = len(self.message_ids)
+        self.message_ids[message] = message_id
+        self.write(TraceMessage(
+            message_id,
+            message.sender,
+            self.block_id(message.block),
+            self.block_id(message.block.parent_block),
+            NO_MESSAGE if prev_message is None else self.message_ids[prev_message],
+            [(sender, self.message_ids[latest_message]) for sender, latest_message in changed],
+        ))
+
+    def write_messages(self, messages: Iterable[Message]) -> None:
+        for message in messages:
+            self.write_message(message)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> 'TraceWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
@@ -0,0 +1,338 @@
+import os
+import struct
+import zlib
+from array import array
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+)
+
+from cbc_lmd.block_store import (
+    AnyBlock,
+    BlockStore,
+    StoredBlock,
+    as_block,
+    as_stored_block,
+)
+from cbc_lmd.main import CompressedTree
+from cbc_lmd.message import (
+    Message,
+    Validator,
+)
+from cbc_lmd.persistent import PersistentMap
+
+# the type of the record, the length of its payload and the crc32 of the payload
+RECORD_HEADER = struct.Struct('<BxxxII')
+# blocks added to the store: the index of the first, and how many there are, then their parents
+# and names
+BLOCKS = 1
+BLOCKS_HEADER = struct.Struct('<qq')
+# (validator, block index) updates to the latest blocks of a tree
+VOTES = 2
+# a message: its id, sender, block index, the id of the sender's previous message (or NO_MESSAGE)
+# and the number of latest messages that changed since it, then (sender, id) pairs for them
+MESSAGE = 3
+MESSAGE_HEADER = struct.Struct('<qqqqq')
+# (validator, weight) changes to the weights of validators
+WEIGHTS = 4
+NO_MESSAGE = -1
+SEGMENT_SUFFIX = '.wal'
+
+
+def segment_name(number: int) -> str:
+    return '{:08d}{}'.format(number, SEGMENT_SUFFIX)
+
+
+class WriteAheadLog:
+    # An append-only log of the blocks, votes, weights and messages a tree or validator has seen,
+    # so they can be recovered after a crash. Records are buffered, and written with a single fsync
+    # once batch_bytes of them have built up or on flush, so only flushed records are sure to
+    # survive.
+    # The log is split into segments of about segment_bytes, and the segments from before a
+    # snapshot can be removed. Blocks are logged by their index in the store, so only StoredBlocks
+    # can be logged.
+    def __init__(self,
+                 directory: str,
+                 store: BlockStore,
+                 segment_bytes: int=64 << 20,
+                 batch_bytes: int=1 << 20) -> None:
+        self.directory = directory
+        self.store = store
+        self.segment_bytes = segment_bytes
+        self.batch_bytes = batch_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self.segment_numbers()
+        # records can only be added to a log once it has been replayed, so the blocks and messages
+        # already in it are known
+        self.replayed = len(self.segments) == 0
+        # the blocks in the store before logged_blocks are already in the log or a snapshot
+        self.logged_blocks = 0
+        self.message_ids = dict()  # type: Dict[Message, int]
+        self.buffer = bytearray()
+        self.file = None  # type: Any
+        self.segment_size = 0
+
+    def segment_numbers(self) -> List[int]:
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def add_record(self, record_type: int, payload: bytes) -> None:
+        if not self.replayed:
+            raise Exception("The log in {} has to be replayed before records are added".format(self.directory))
+        self.buffer += RECORD_HEADER.pack(record_type, len(payload), zlib.crc32(payload))
+        self.buffer += payload
+        if len(self.buffer) >= self.batch_bytes:
+            self.flush()
+
+    def log_new_blocks(self) -> None:
+        # log the blocks added to the store since the last ones logged
+        if self.logged_blocks >= len(self.store):
+            return
+        start, end = self.logged_blocks, len(self.store)
+        self.add_record(
+            BLOCKS,
+            BLOCKS_HEADER.pack(start, end - start)
+            + self.store.parents[start:end].tobytes()
+            + self.store.names[start:end].tobytes()
+        )
+        self.logged_blocks = end
+
+    def log_votes(self, updates: Iterable[Tuple[AnyBlock, int]]) -> None:
+        self.log_new_blocks()
+        votes = array('q')
+        for block, validator in updates:
+            votes.append(validator)
+            votes.append(as_stored_block(block).index)
+        self.add_record(VOTES, votes.tobytes())
+
+    def log_weights(self, weights: Dict[int, int]) -> None:
+        values = array('q')
+        for validator, weight in weights.items():
+            values.append(validator)
+            values.append(weight)
+        self.add_record(WEIGHTS, values.tobytes())
+
+    def log_messages(self, messages: Iterable[Message]) -> None:
+        # the messages have to come after the messages in their justifications
+        self.log_new_blocks()
+        for message in messages:
+            if message not in self.message_ids:
+                self.log_message(message)
+
+    def log_message(self, message: Message) -> None:
+        prev_message = message.prev_message
+        if prev_message is None:
+            changed = list(message.latest_messages.items())
+        else:
+            changed = list(message.latest_messages.changed_items(prev_message.latest_messages))
+        if (prev_message is not None and prev_message not in self.message_ids) or any(
+            latest_message not in self.message_ids for _, latest_message in changed
+        ):
+            # the log was started after some of the justification was seen, so log it first
+            for unlogged in self.unlogged_justification(message)[:-1]:
+                self.log_message(unlogged)
+        latest_messages = array('q')
+        for sender, latest_message in changed:
+            latest_messages.append(sender)
+            latest_messages.append(self.message_ids[latest_message])
+        message_id = len(self.message_ids)
+        prev_id = NO_MESSAGE if prev_message is None else self.message_ids[prev_message]
+        self.add_record(
+            MESSAGE,
+            MESSAGE_HEADER.pack(
+                message_id, message.sender, as_stored_block(message.block).index, prev_id, len(latest_messages) // 2
+            ) + latest_messages.tobytes()
+        )
+        self.message_ids[message] = message_id
+
+    def unlogged_justification(self, message: Message) -> List[Message]:
+        # the message and the messages in its justification that have not been logged, ordered so
+        # every message comes after the messages it justifies
+        unlogged = []  # type: List[Message]
+        visited = {message}
+        stack = [(message, self.dependencies(message))]
+        while len(stack) > 0:
+            current, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency not in visited and dependency not in self.message_ids:
+                    visited.add(dependency)
+                    stack.append((dependency, self.dependencies(dependency)))
+                    break
+            else:
+                stack.pop()
+                unlogged.append(current)
+        return unlogged
+
+    def dependencies(self, message: Message) -> Iterator[Message]:
+        if message.prev_message is not None:
+            yield message.prev_message
+        yield from message.latest_messages.values()
+
+    def flush(self) -> None:
+        if len(self.buffer) == 0:
+            return
+        if self.file is None or self.segment_size >= self.segment_bytes:
+            self.next_segment()
+        self.file.write(self.buffer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.segment_size += len(self.buffer)
+        self.buffer = bytearray()
+
+    def next_segment(self) -> None:
+        # new segments are started rather than appending to old ones, which may end in a record
+        # that was cut short by a crash
+        if self.file is not None:
+            self.file.close()
+        number = self.segments[-1] + 1 if len(self.segments) > 0 else 0
+        self.segments.append(number)
+        self.file = open(os.path.join(self.directory, segment_name(number)), 'ab')
+        self.segment_size = 0
+        self.sync_directory()
+
+    def sync_directory(self) -> None:
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def checkpoint(self) -> int:
+        # flush, and start a new segment for the records after this point. Once a snapshot of the
+        # tree at this point is written, the segments before the number returned can be removed.
+        self.flush()
+        self.next_segment()
+        return self.segments[-1]
+
+    def remove_segments_before(self, number: int) -> None:
+        # messages can only be replayed from the log with the messages they refer to, so this is
+        # only for logs that are replayed into a tree from a snapshot
+        for old in [segment for segment in self.segments if segment < number]:
+            os.remove(os.path.join(self.directory, segment_name(old)))
+            self.segments.remove(old)
+        self.sync_directory()
+
+    def close(self) -> None:
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self) -> 'WriteAheadLog':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def records(self) -> Iterator[Tuple[int, memoryview]]:
+        # the records in the log, in order. A segment ends at the first record that was cut short or
+        # corrupted, as the records after it in the segment were not flushed.
+        for number in self.segment_numbers():
+            with open(os.path.join(self.directory, segment_name(number)), 'rb') as f:
+                data = memoryview(f.read())
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(data):
+                record_type, length, crc = RECORD_HEADER.unpack_from(data, offset)
+                payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                yield record_type, payload
+                offset += RECORD_HEADER.size + length
+
+    def replay_blocks(self, payload: memoryview) -> None:
+        start, count = BLOCKS_HEADER.unpack_from(payload, 0)
+        parents = array('i')
+        parents.frombytes(payload[BLOCKS_HEADER.size:BLOCKS_HEADER.size + 4 * count])
+        names = array('q')
+        names.frombytes(payload[BLOCKS_HEADER.size + 4 * count:])
+        # the store may already have some of the blocks, from a snapshot
+        for idx in range(max(0, len(self.store) - start), count):
+            if start + idx != len(self.store):
+                raise Exception("Block {} is missing from the log".format(len(self.store)))
+            self.store.add(parents[idx], names[idx])
+        self.logged_blocks = len(self.store)
+
+    def replay_weights(self, payload: memoryview) -> Dict[int, int]:
+        values = payload.cast('q')
+        return {values[idx]: values[idx + 1] for idx in range(0, len(values), 2)}
+
+    def replay_into_tree(self, tree: CompressedTree) -> None:
+        # replay the votes, and the messages' blocks as their senders' votes, into the tree. Only
+        # the final latest block of each validator is added to the tree, in one batch.
+        latest_blocks = dict()  # type: Dict[int, int]
+        # the height of the latest message from each sender, as messages are only counted if they
+        # are later than the sender's latest message
+        message_heights = dict()  # type: Dict[int, int]
+        heights_of_ids = dict()  # type: Dict[int, int]
+        weights = dict()  # type: Dict[int, int]
+        for record_type, payload in self.records():
+            if record_type == BLOCKS:
+                self.replay_blocks(payload)
+            elif record_type == WEIGHTS:
+                weights.update(self.replay_weights(payload))
+            elif record_type == VOTES:
+                votes = payload.cast('q')
+                for idx in range(0, len(votes), 2):
+                    latest_blocks[votes[idx]] = votes[idx + 1]
+            elif record_type == MESSAGE:
+                message_id, sender, block, prev_id, _ = MESSAGE_HEADER.unpack_from(payload, 0)
+                height = heights_of_ids.get(prev_id, -1) + 1
+                heights_of_ids[message_id] = height
+                if height > message_heights.get(sender, -1):
+                    message_heights[sender] = height
+                    latest_blocks[sender] = block
+        # the scores only depend on the final weights and latest blocks, so neither has to be
+        # replayed in order
+        self.replayed = True
+        self.logged_blocks = len(self.store)
+        tree.set_validator_weights(weights)
+        tree.add_new_latest_blocks(
+            (as_block(StoredBlock(store=self.store, index=block)), validator)
+            for validator, block in latest_blocks.items()
+        )
+
+    def replay_into_validator(self, validator: Validator) -> None:
+        # rebuild the messages a new validator had seen and made, and its tree from their latest
+        # messages. The validator's genesis must be the first block in the store.
+        messages = []  # type: List[Message]
+        weights = dict()  # type: Dict[int, int]
+        for record_type, payload in self.records():
+            if record_type == BLOCKS:
+                self.replay_blocks(payload)
+            elif record_type == WEIGHTS:
+                weights.update(self.replay_weights(payload))
+            elif record_type == MESSAGE:
+                message_id, sender, block, prev_id, num_changed = MESSAGE_HEADER.unpack_from(payload, 0)
+                if message_id != len(messages):
+                    raise Exception("Message {} is missing from the log".format(len(messages)))
+                changed = payload[MESSAGE_HEADER.size:MESSAGE_HEADER.size + 16 * num_changed].cast('q')
+                latest_messages = {changed[idx]: messages[changed[idx + 1]] for idx in range(0, len(changed), 2)}
+                prev_message = None if prev_id == NO_MESSAGE else messages[prev_id]
+                if prev_message is not None:
+                    latest_messages = prev_message.latest_messages.update(latest_messages)
+                messages.append(Message(sender, as_block(StoredBlock(store=self.store, index=block)), latest_messages,
+                                        prev_message=prev_message))
+
+        new_latest_messages = dict()  # type: Dict[int, Message]
+        for message in messages:
+            self.message_ids[message] = len(self.message_ids)
+            validator.justification.add(message)
+            if message.sender == validator.name:
+                validator.own_message_at_height[message.message_height] = message
+            latest_message = new_latest_messages.get(message.sender, None)
+            if latest_message is None or message.message_height > latest_message.message_height:
+                new_latest_messages[message.sender] = message
+        self.replayed = True
+        self.logged_blocks = len(self.store)
+        validator.latest_messages = PersistentMap(new_latest_messages)
+        validator.weight.update(weights)
+        validator.tree.set_validator_weights(weights)
+        validator.tree.add_new_latest_blocks(
+            (message.block, sender) for sender, message in new_latest_messages.items()
+        )
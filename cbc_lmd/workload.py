@@ -0,0 +1,148 @@
+import random
+from collections import deque
+
+from typing import (
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from cbc_lmd.block_store import (
+    AnyBlock,
+    BlockStore,
+    StoredBlock,
+    as_block,
+)
+from cbc_lmd.main import Block
+from cbc_lmd.message import (
+    Message,
+    ValidatorSet,
+)
+from cbc_lmd.trace import TraceWriter
+
+WEIGHT_DISTRIBUTIONS = ['equal', 'uniform', 'pareto']
+
+
+def make_weights(num_validators: int,
+                 distribution: str,
+                 rng: random.Random,
+                 max_weight: int=32,
+                 alpha: float=1.16) -> Dict[int, int]:
+    # equal gives every validator weight 1, uniform a weight from 1 to max_weight, and pareto a
+    # heavy tailed weight (alpha = 1.16 gives the 80/20 rule), capped at max_weight
+    if distribution == 'equal':
+        return {v: 1 for v in range(num_validators)}
+    if distribution == 'uniform':
+        return {v: rng.randint(1, max_weight) for v in range(num_validators)}
+    if distribution == 'pareto':
+        return {v: min(max_weight, int(rng.paretovariate(alpha))) for v in range(num_validators)}
+    raise Exception("Unknown weight distribution {}, not one of {}".format(distribution, WEIGHT_DISTRIBUTIONS))
+
+
+class Workload:
+    # Reproducible streams of blocks and votes, or of messages, from a seed. Validators are honest,
+    # late or equivocating:
+    # - as votes, honest validators vote for the tip of the chain, late validators for the block
+    #   late_delay blocks before it, and equivocating validators for any of the recent blocks,
+    #   flipping between forks.
+    # - as messages, honest validators see every message at the end of the round it was made in,
+    #   late validators late_delay rounds later, and equivocating validators make a second message
+    #   each round, on a different block from the same previous message.
+    # The blocks are StoredBlocks by default, as they hash to their index, so the fork choice breaks
+    # ties the same way every run, and they take little memory for millions of blocks.
+    def __init__(self,
+                 num_validators: int,
+                 seed: int=0,
+                 weights: Union[str, Dict[int, int]]='equal',
+                 fork_probability: float=0.0,
+                 max_reorg_depth: int=1,
+                 late_fraction: float=0.0,
+                 late_delay: int=4,
+                 equivocating_fraction: float=0.0,
+                 genesis: Optional[AnyBlock]=None) -> None:
+        self.num_validators = num_validators
+        self.rng = random.Random(seed)
+        if isinstance(weights, str):
+            self.weight = make_weights(num_validators, weights, self.rng)
+        else:
+            self.weight = dict(weights)
+        self.fork_probability = fork_probability
+        self.max_reorg_depth = max_reorg_depth
+        self.late_delay = late_delay
+        names = list(range(num_validators))
+        self.rng.shuffle(names)
+        num_late = int(round(late_fraction * num_validators))
+        num_equivocating = int(round(equivocating_fraction * num_validators))
+        self.late = set(names[:num_late])  # type: Set[int]
+        self.equivocating = set(names[num_late:num_late + num_equivocating])  # type: Set[int]
+        if genesis is None:
+            genesis = StoredBlock(None, store=BlockStore())
+        # the blocks are all built like the genesis, so are Blocks or StoredBlocks throughout
+        self.genesis = as_block(genesis)
+        self.tip = self.genesis
+        # the most recent blocks, for late and equivocating votes
+        self.recent = deque([self.genesis], maxlen=late_delay + 1)  # type: Deque[Block]
+
+    def blocks(self, num_blocks: int) -> Iterator[Block]:
+        # each block builds on the tip, or with fork_probability on an ancestor of the tip up to
+        # max_reorg_depth blocks back, which then becomes the tip
+        for _ in range(num_blocks):
+            parent = self.tip
+            if self.rng.random() < self.fork_probability and self.tip.height > 0:
+                depth = self.rng.randint(1, min(self.max_reorg_depth, self.tip.height))
+                parent = self.tip.prev_at_height(self.tip.height - depth)
+            # build the same kind of block as the genesis (e.g. a Block, or a StoredBlock)
+            self.tip = type(parent)(parent)
+            self.recent.append(self.tip)
+            yield self.tip
+
+    def vote(self, validator: int) -> Block:
+        if validator in self.late:
+            return self.recent[0]
+        if validator in self.equivocating:
+            return self.recent[self.rng.randrange(len(self.recent))]
+        return self.tip
+
+    def votes(self, num_blocks: int, votes_per_block: int=1) -> Iterator[Tuple[Block, int]]:
+        # (block, validator) votes, from random validators, after each new block
+        for _ in self.blocks(num_blocks):
+            for _ in range(votes_per_block):
+                validator = self.rng.randrange(self.num_validators)
+                yield self.vote(validator), validator
+
+    def messages(self, num_rounds: int, message_probability: float=1.0) -> Iterator[Message]:
+        # the messages made each round, each after the messages in its justification
+        validator_set = ValidatorSet(self.num_validators, self.weight, self.genesis)
+        # the messages that reach late validators late_delay rounds after they are made
+        delayed = deque()  # type: Deque[List[Message]]
+        for _ in range(num_rounds):
+            made = []  # type: List[Message]
+            for name in range(self.num_validators):
+                if self.rng.random() >= message_probability:
+                    continue
+                message = validator_set.validators[name].make_new_message()
+                made.append(message)
+                if name in self.equivocating:
+                    parent = message.block.parent_block
+                    made.append(Message(
+                        name, type(parent)(parent), message.latest_messages, prev_message=message.prev_message
+                    ))
+            for message in made:
+                yield message
+
+            delayed.append(made)
+            late_messages = delayed.popleft() if len(delayed) > self.late_delay else []
+            for name, val in validator_set.validators.items():
+                for message in (late_messages if name in self.late else made):
+                    if message.sender != name:
+                        val.see_message(message)
+
+    def write_trace(self, path: str, num_rounds: int, message_probability: float=1.0, binary: bool=False) -> None:
+        with TraceWriter(path, self.genesis, binary=binary) as writer:
+            writer.write_weights(self.weight)
+            writer.write_messages(self.messages(num_rounds, message_probability))
@@ -1,12 +1,53 @@
+import functools
+import gc
 import random
+import weakref
+import cbc_lmd.main
+from benchmarks.naive_ghost import FullTreeGhost
 from cbc_lmd.main import (
     Block,
     CompressedTree,
+    JumpBlock,
+)
+from cbc_lmd.lca_index import LCAIndex
+from cbc_lmd.block_store import (
+    BlockStore,
+    StoredBlock,
 )
 from cbc_lmd.message import (
     LayerStore,
+    MultiQuorumLayers,
+    PathFinality,
+    Validator,
     ValidatorSet
 )
+from cbc_lmd.numpy_layer_store import (
+    MessageMatrix,
+    NumpyLayerStore,
+)
+from cbc_lmd.network import (
+    NetworkModel,
+    NetworkSimulator,
+    Partition,
+    constant_latency,
+)
+from cbc_lmd.parallel import ParallelSimulation
+from cbc_lmd.persistent import PersistentMap
+from cbc_lmd.replay import Replay
+from cbc_lmd.snapshot import (
+    load_snapshot,
+    write_snapshot,
+)
+from cbc_lmd.stats import (
+    STATS,
+    tree_shape,
+)
+from cbc_lmd.trace import TraceWriter
+from cbc_lmd.wal import (
+    WriteAheadLog,
+    segment_name,
+)
+from cbc_lmd.workload import Workload
 
 
 def test_inserting_on_genesis():
@@ -141,6 +182,45 @@ def test_new_finalised_node_pruning():
     assert tree.size == 4
 
 
+def test_pruning_removes_old_nodes():
+    genesis = Block(None)
+    tree = CompressedTree(genesis, use_lca_index=True)
+
+    # validator 0 builds a chain, validator 1 forks off it at genesis, validator 2 votes on genesis
+    chain = [genesis]
+    for _ in range(5):
+        chain.append(Block(chain[-1]))
+    tree.add_new_latest_block(chain[5], 0)
+    fork = Block(Block(genesis))
+    tree.add_new_latest_block(fork, 1)
+    tree.add_new_latest_block(genesis, 2)
+    tree.add_new_latest_block(chain[3], 3)
+
+    fork_ref = weakref.ref(fork)
+    new_root = tree.node_with_block[chain[3]]
+    assert tree.prune(new_root) == {1, 2}
+
+    assert tree.root == new_root and new_root.parent is None
+    assert tree.size == 2
+    assert set(tree.node_with_block) == {chain[3], chain[5]}
+    assert set(tree.heights) == {3, 5}
+    assert set(tree.blocks_at_height) == {3, 5}
+    assert list(tree.path_block_to_child_node.values()) == [tree.node_with_block[chain[5]]]
+    assert tree.latest_block_nodes[1] is None and tree.latest_block_nodes[2] is None
+    assert tree.root.score == 2
+    assert tree.find_head().block == chain[5]
+
+    # the tree no longer refers to blocks that were pruned
+    del fork
+    gc.collect()
+    assert fork_ref() is None
+
+    # validators with pruned latest blocks can vote again
+    tree.add_new_latest_block(Block(chain[5]), 1)
+    assert tree.latest_block_nodes[1].parent.block == chain[5]
+    assert tree.root.score == 3
+
+
 def test_ghost():
     # Setup
     genesis = Block(None)
@@ -326,6 +406,31 @@ def test_make_new_messages_on_eachothers():
             for i in range(3):
                 assert val.latest_messages[i] in latest
 
+
+def test_deeper_than_recursion_limit():
+    depth = 3000
+    genesis = Block(None)
+    tree = CompressedTree(genesis)
+
+    # every validator has a latest block one after the last, so the tree is a path of nodes
+    block = genesis
+    for i in range(depth):
+        block = Block(block)
+        tree.add_new_latest_block(block, i)
+    assert tree.size == depth + 1
+    assert tree.root.size == depth + 1
+    assert len(tree.all_nodes()) == depth + 1
+    scores = tree.calculate_scores(tree.root, {block: 1}, dict())
+    assert scores[tree.root] == 1
+    assert tree.find_head().block == block
+
+    val_set = ValidatorSet(2)
+    for i in range(depth):
+        last_message = val_set.make_new_message(0)
+    val_set.send_message(last_message, 1)
+    assert len(val_set.validators[1].justification) == depth
+    assert val_set.validators[1].latest_messages[0] == last_message
+
 def test_build_graph_basic():
     val_set = ValidatorSet(3)
 
@@ -385,4 +490,914 @@ def test_build_graph_two_layers_incremental():
     for val in layer_store.layers[1]:
         assert layer_store.layers[1][val] in one
     for val in layer_store.layers[0]:
-        assert layer_store.layers[0][val] in zero
\ No newline at end of file
+        assert layer_store.layers[0][val] in zero
+
+def test_build_next_layer_finds_first_message_with_q():
+    random.seed(13)
+    val_set = ValidatorSet(5)
+    validators = list(val_set.validators.values())
+    messages = []
+    for _ in range(60):
+        val = random.choice(validators)
+        for message in random.sample(messages, min(len(messages), 3)):
+            val.see_message(message)
+        messages.append(val.make_new_message())
+
+    layer_store = LayerStore(val_set, val_set.genesis, 3)
+    assert len(layer_store.layers) > 2
+    for height in range(len(layer_store.layers) - 1):
+        prev_layer = layer_store.layers[height]
+        layer = layer_store.layers[height + 1]
+        for val in prev_layer:
+            own = val.own_message_at_height
+            first = prev_layer[val].message_height
+            qualifying = [own[i] for i in range(first, len(own)) if layer_store.weight_seen(own[i], prev_layer) >= 3]
+            if len(qualifying) == 0:
+                assert val not in layer
+            else:
+                assert layer[val] == qualifying[0]
+
+def test_numpy_layer_store_matches_layer_store():
+    random.seed(14)
+    weight = {v: random.randint(1, 4) for v in range(6)}
+    val_set = ValidatorSet(6, weight)
+    validators = list(val_set.validators.values())
+    layer_store = LayerStore(val_set, val_set.genesis, 9)
+    numpy_layer_store = NumpyLayerStore(val_set, val_set.genesis, 9)
+    messages = []
+    for _ in range(80):
+        val = random.choice(validators)
+        for message in random.sample(messages, min(len(messages), 3)):
+            val.see_message(message)
+        new_message = val.make_new_message()
+        messages.append(new_message)
+        layer_store.add_message(new_message)
+        numpy_layer_store.add_message(new_message)
+        assert numpy_layer_store.layers == layer_store.layers
+
+    layer_store = LayerStore(val_set, val_set.genesis, 9)
+    numpy_layer_store = NumpyLayerStore(val_set, val_set.genesis, 9)
+    assert len(layer_store.layers) > 2
+    assert numpy_layer_store.layers == layer_store.layers
+    assert numpy_layer_store.fault_tolerance() == layer_store.fault_tolerance()
+
+def test_path_finality_matches_layer_store_per_block():
+    random.seed(15)
+    val_set = ValidatorSet(5)
+    validators = list(val_set.validators.values())
+    messages = []
+    for _ in range(60):
+        val = random.choice(validators)
+        for message in random.sample(messages, min(len(messages), 2)):
+            val.see_message(message)
+        messages.append(val.make_new_message())
+
+    head = validators[0].forkchoice()
+    path_finality = PathFinality(val_set, val_set.genesis, head, 4)
+    assert path_finality.path[0] == val_set.genesis and path_finality.path[-1] == head
+    fault_tolerances = path_finality.fault_tolerances()
+    for idx, block in enumerate(path_finality.path):
+        layer_store = LayerStore(val_set, block, 4)
+        assert path_finality.first_layer(idx) == layer_store.layers[0]
+        assert fault_tolerances[idx] == layer_store.fault_tolerance()
+    assert fault_tolerances == sorted(fault_tolerances, reverse=True)
+
+    t = fault_tolerances[len(fault_tolerances) // 2]
+    highest = path_finality.highest_block_with_fault_tolerance(t)
+    assert highest == max(
+        (block for block, ft in zip(path_finality.path, fault_tolerances) if ft >= t), key=lambda b: b.height
+    )
+    assert path_finality.highest_block_with_fault_tolerance(fault_tolerances[0] + 1) is None
+
+def test_multi_quorum_layers_match_layer_store_per_q():
+    random.seed(16)
+    val_set = ValidatorSet(5)
+    validators = list(val_set.validators.values())
+    messages = []
+    for _ in range(60):
+        val = random.choice(validators)
+        for message in random.sample(messages, min(len(messages), 3)):
+            val.see_message(message)
+        messages.append(val.make_new_message())
+
+    qs = [5, 2, 3, 4]
+    matrix = MessageMatrix(5)
+    for layer_store in [LayerStore, functools.partial(NumpyLayerStore, matrix=matrix)]:
+        multi_quorum_layers = MultiQuorumLayers(val_set, val_set.genesis, qs, layer_store)
+        layer_counts = multi_quorum_layers.layer_counts()
+        fault_tolerances = multi_quorum_layers.fault_tolerances()
+        for q in qs:
+            single_q_layers = LayerStore(val_set, val_set.genesis, q)
+            assert multi_quorum_layers.layer_stores[q].layers == single_q_layers.layers
+            assert layer_counts[q] == len(single_q_layers.layers)
+            assert fault_tolerances[q] == single_q_layers.fault_tolerance()
+        assert layer_counts[2] > layer_counts[5]
+
+def test_parallel_simulation_is_the_same_for_any_number_of_workers():
+    heads = []
+    for num_workers in [0, 1, 3]:
+        with ParallelSimulation(7, num_workers, seed=17, message_probability=.7, delivery_probability=.5) as sim:
+            sim.run(12)
+            heads.append(sim.heads())
+    assert heads[0] == heads[1] == heads[2]
+    assert len(set(heads[0].values())) > 1
+
+    with ParallelSimulation(7, seed=17, message_probability=.7, delivery_probability=.5) as sim:
+        sim.run(12)
+        assert sim.heads() == heads[0]
+
+def test_parallel_simulation_surfaces_worker_failures():
+    with ParallelSimulation(4, 2) as sim:
+        sim.run(2)
+        # validator 1 is not in the first shard, so the worker fails, and reports why
+        sim.connections[0].send(('step', b'', {1: []}, []))
+        error = ''
+        try:
+            sim.receive(0)
+        except Exception as e:
+            error = str(e)
+        assert 'KeyError' in error
+        # the worker has exited, so the next step raises rather than waiting on it forever
+        sim.workers[0].join()
+        try:
+            sim.step()
+        except Exception as e:
+            error = str(e)
+        assert 'exited' in error
+
+def test_network_simulator_partition():
+    val_set = ValidatorSet(6)
+    groups = [{0, 1, 2}, {3, 4, 5}]
+    network = NetworkModel(constant_latency(.2), bandwidth=10000, partitions=[Partition(0, 100, groups)])
+    report = NetworkSimulator(val_set, network, time_scale=.002).run(8)
+
+    assert report['messages_made'] > 0
+    assert report['messages_seen'] > 0
+    assert report['messages_dropped'] > 0
+    latency = report['fork_choice_latency']
+    assert latency['p50'] <= latency['p90'] <= latency['p99']
+    assert len(report['tree_sizes']) > 0
+    # no message crosses the partition
+    for group in groups:
+        for name in group:
+            assert set(val_set.validators[name].latest_messages) <= group
+
+
+def test_replay_trace_out_of_order(tmp_path):
+    random.seed(23)
+    # weights that are distinct powers of two, so no two subtrees tie
+    weight = {v: 2 ** v for v in range(4)}
+    val_set = ValidatorSet(4, weight=weight)
+    messages = []
+    for _ in range(10):
+        for val in val_set:
+            messages.append(val.make_new_message())
+        for val in val_set:
+            for message in random.sample(messages, 2):
+                val.see_message(message)
+    observer = Validator(-1, val_set.genesis, weight)
+    for message in messages:
+        observer.see_message(message)
+
+    path = str(tmp_path / 'trace')
+    with TraceWriter(path, val_set.genesis) as writer:
+        writer.write_weights(weight)
+        writer.write_messages(messages)
+    # messages recorded before the messages they depend on are held back until they are seen
+    with open(path) as f:
+        lines = f.readlines()
+    lines[4:10] = reversed(lines[4:10])
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+    report = Replay(max_pending=10).run(path)
+    assert report['messages'] == len(messages)
+    assert report['head'] == writer.block_ids[observer.forkchoice()]
+    assert report['stages']['see_message']['items'] == len(messages)
+
+    # the binary format replays to the same head
+    binary_path = str(tmp_path / 'trace.bin')
+    with TraceWriter(binary_path, val_set.genesis, binary=True) as binary_writer:
+        binary_writer.write_weights(weight)
+        binary_writer.write_messages(messages)
+    binary_report = Replay().run(binary_path)
+    assert binary_report['messages'] == len(messages)
+    assert binary_report['head'] == report['head'] == binary_writer.block_ids[observer.forkchoice()]
+    assert binary_report['head_height'] == report['head_height']
+
+
+def test_workload_is_reproducible(tmp_path):
+    def votes_head(seed):
+        workload = Workload(20, seed=seed, weights='pareto', fork_probability=.2, max_reorg_depth=4,
+                            late_fraction=.2, equivocating_fraction=.1)
+        tree = CompressedTree(workload.genesis, workload.weight)
+        for block, validator in workload.votes(500, votes_per_block=2):
+            tree.add_new_latest_block(block, validator)
+        return tree.find_head().block.index, workload.genesis.store.heights
+
+    assert votes_head(1) == votes_head(1)
+
+    def messages(seed):
+        workload = Workload(6, seed=seed, weights='uniform', late_fraction=.2, equivocating_fraction=.2)
+        return [(m.sender, m.block.index, m.message_height) for m in workload.messages(8)]
+
+    assert messages(2) == messages(2)
+    # equivocating validators make two messages at the same height
+    assert len(messages(2)) == len(set(messages(2))) == 8 * 7
+
+    path = str(tmp_path / 'trace')
+    Workload(6, seed=2, weights='uniform', late_fraction=.2, equivocating_fraction=.2).write_trace(path, 8)
+    assert Replay().run(path)['messages'] == 8 * 7
+
+def test_full_tree_ghost_matches_compressed_tree():
+    random.seed(19)
+    # weights that are distinct powers of two, so no two subtrees tie, and equal weights, so
+    # subtrees often tie and the same block has to be chosen to break them
+    for weight in [{v: 2 ** v for v in range(8)}, {v: 1 for v in range(8)}]:
+        genesis = Block(None)
+        tree = CompressedTree(genesis, weight)
+        naive = FullTreeGhost(genesis, weight)
+        blocks = [genesis]
+        for i in range(300):
+            block = Block(random.choice(blocks[-10:]))
+            blocks.append(block)
+            naive.add_block(block)
+            if random.random() < .5:
+                validator = random.randrange(8)
+                tree.add_new_latest_block(block, validator)
+                naive.add_new_latest_block(block, validator)
+                assert tree.find_head().block == naive.find_head()
+
+def test_stats_count_hot_paths_only_while_enabled():
+    prev_at_height = Block.prev_at_height
+    genesis = Block(None)
+    tree = CompressedTree(genesis)
+    blocks = [genesis]
+    for i in range(200):
+        blocks.append(Block(blocks[random.randint(max(0, i - 8), i)]))
+
+    dumps = []
+    STATS.reset()
+    STATS.set_dump_hook(dumps.append, interval=0)
+    STATS.enable()
+    try:
+        for i, block in enumerate(blocks[1:]):
+            tree.add_new_latest_block(block, i % 10)
+            tree.find_head()
+        snapshot = STATS.snapshot()
+    finally:
+        STATS.disable()
+        STATS.set_dump_hook(None)
+
+    counters = snapshot['counters']
+    assert counters['Block.prev_at_height.hops'] > 0
+    assert counters['CompressedTree.add_block_with_weight.no_overlap'] > 0
+    assert counters['CompressedTree.find_head.reruns'] > 0
+    assert snapshot['timers']['CompressedTree.find_head']['calls'] == 200
+    assert len(dumps) > 0
+    assert tree_shape(tree)['size'] == tree.size
+
+    # nothing is recorded once disabled, and the methods are unwrapped
+    assert Block.prev_at_height is prev_at_height
+    tree.add_new_latest_block(Block(blocks[-1]), 0)
+    assert STATS.snapshot() == snapshot
+    STATS.reset()
+
+def test_scores_follow_latest_blocks():
+    genesis = Block(None)
+    tree = CompressedTree(genesis, {0: 1, 1: 2, 2: 4})
+
+    block_1 = Block(genesis)
+    block_2 = Block(genesis)
+    node_1 = tree.add_new_latest_block(block_1, 0)
+    node_2 = tree.add_new_latest_block(block_2, 1)
+    assert tree.root.score == 3
+    assert tree.find_head() == node_2
+
+    # validator 2 votes on an ancestor of validator 0's next block, splicing the edge
+    block_3 = Block(Block(block_1))
+    node_3 = tree.add_new_latest_block(block_3, 0)
+    node_4 = tree.add_new_latest_block(block_3.parent_block, 2)
+    assert node_4.children == {node_3}
+    assert node_4.score == 5
+    assert tree.root.score == 7
+    assert tree.find_head() == node_3
+
+    # validators can share a latest block
+    tree.add_new_latest_block(block_2, 2)
+    assert tree.node_with_block[block_2].score == 6
+    assert tree.find_head() == tree.node_with_block[block_2]
+    assert tree.size == 3
+
+    tree.add_new_latest_block(Block(block_2), 1)
+    assert tree.node_with_block[block_2].weight == 4
+    assert tree.root.score == 7
+
+
+def test_jump_block_ancestors():
+    blocks = [JumpBlock(None)]
+    for i in range(1024):
+        parent = random.randint(max(0, i - 20), i) if i % 7 == 0 else i
+        blocks.append(JumpBlock(blocks[parent]))
+
+    for block in blocks:
+        # each jump is one of the skew-binary lengths 2**k - 1
+        if block.jump is not None:
+            length = block.height - block.jump.height
+            assert length & (length + 1) == 0
+
+    for _ in range(1000):
+        block_1 = random.choice(blocks)
+        block_2 = random.choice(blocks)
+        height = random.randint(0, block_1.height)
+        ancestor = block_1.prev_at_height(height)
+
+        expected = block_1
+        while expected.height > height:
+            expected = expected.parent_block
+        assert ancestor == expected
+        assert block_1.on_top(ancestor)
+
+        lca = block_1.lca(block_2)
+        assert block_1.on_top(lca) and block_2.on_top(lca)
+        assert lca.height == max(b.height for b in blocks if block_1.on_top(b) and block_2.on_top(b))
+
+
+def test_tree_of_jump_blocks():
+    val_set = ValidatorSet(3, genesis=JumpBlock(None))
+    for i in range(20):
+        latest = set()
+        for val in val_set:
+            latest.add(val.make_new_message())
+        for val in val_set:
+            for m in latest:
+                val.see_message(m)
+
+    for val in val_set:
+        assert isinstance(val.forkchoice(), JumpBlock)
+        assert val.forkchoice().height == 20
+
+
+def test_block_store_matches_blocks():
+    store = BlockStore()
+    blocks = [Block(None)]
+    stored = [StoredBlock(None, store=store)]
+    for i in range(300):
+        parent = random.randint(max(0, i - 20), i)
+        blocks.append(Block(blocks[parent]))
+        stored.append(StoredBlock(stored[parent]))
+
+    assert len(store) == len(blocks)
+    for _ in range(500):
+        i = random.randint(0, len(blocks) - 1)
+        j = random.randint(0, len(blocks) - 1)
+        assert stored[i].height == blocks[i].height
+        assert stored[i].lca(stored[j]).index == blocks.index(blocks[i].lca(blocks[j]))
+        assert stored[i].on_top(stored[j]) == blocks[i].on_top(blocks[j])
+        height = random.randint(0, blocks[i].height)
+        assert stored[i].prev_at_height(height).index == blocks.index(blocks[i].prev_at_height(height))
+        assert stored[i].skip_list == [
+            None if block is None else stored[blocks.index(block)] for block in blocks[i].skip_list
+        ]
+
+
+def test_tree_of_stored_blocks():
+    store = BlockStore()
+    val_set = ValidatorSet(3, genesis=StoredBlock(None, store=store))
+
+    for i in range(10):
+        latest = set()
+        for val in val_set:
+            latest.add(val.make_new_message())
+        for val in val_set:
+            for m in latest:
+                val.see_message(m)
+
+    assert len(store) == 31
+    for val in val_set:
+        head = val.forkchoice()
+        assert isinstance(head, StoredBlock)
+        assert head.height == 10
+        # genesis, and the three latest blocks on the same parent
+        assert val.tree.size == 5
+
+
+def test_snapshot_round_trip(tmp_path):
+    for use_lca_index in [False, True]:
+        store = BlockStore()
+        blocks = [StoredBlock(None, store=store)]
+        tree = CompressedTree(blocks[0], weight={0: 3, 1: 1, 2: 2}, use_lca_index=use_lca_index)
+        for i in range(300):
+            blocks.append(StoredBlock(blocks[random.randint(max(0, i - 10), i)]))
+            if random.random() < 0.5:
+                tree.add_new_latest_block(random.choice(blocks[-20:]), random.randint(0, 2))
+
+        path = str(tmp_path / 'tree_{}.snap'.format(use_lca_index))
+        write_snapshot(path, store, tree)
+        loaded_store, loaded = load_snapshot(path)
+        assert len(loaded_store) == len(store)
+        assert loaded.size == tree.size
+        assert (loaded.lca_index is not None) == use_lca_index
+        assert loaded.find_head().block.index == tree.find_head().block.index
+        for name, node in tree.latest_block_nodes.items():
+            assert loaded.latest_block_nodes[name].block.index == node.block.index
+
+        # blocks can still be voted on and added once loaded, and the trees stay the same
+        loaded_blocks = [StoredBlock(store=loaded_store, index=block.index) for block in blocks]
+        tree.add_new_latest_block(blocks[-5], 1)
+        loaded.add_new_latest_block(loaded_blocks[-5], 1)
+        assert loaded.find_head().block.index == tree.find_head().block.index
+        for i in range(100):
+            parent = random.randint(len(blocks) - 10, len(blocks) - 1)
+            blocks.append(StoredBlock(blocks[parent]))
+            loaded_blocks.append(StoredBlock(loaded_blocks[parent]))
+            name = random.randint(0, 2)
+            tree.add_new_latest_block(blocks[-1], name)
+            loaded.add_new_latest_block(loaded_blocks[-1], name)
+            assert loaded.find_head().block.index == tree.find_head().block.index
+            assert loaded.size == tree.size
+
+
+def test_write_ahead_log_replay(tmp_path):
+    store = BlockStore()
+    val_set = ValidatorSet(4, genesis=StoredBlock(None, store=store))
+    val = val_set.validators[0]
+    val.wal = WriteAheadLog(str(tmp_path / 'validator'), store, segment_bytes=1000, batch_bytes=200)
+    messages = []
+    for _ in range(10):
+        for other in val_set:
+            messages.append(other.make_new_message())
+        for other in val_set:
+            for message in random.sample(messages, 3):
+                other.see_message(message)
+    val.wal.close()
+    assert len(val.wal.segments) > 1
+
+    # a record cut short by a crash is left out
+    with open(str(tmp_path / 'validator' / segment_name(val.wal.segments[-1])), 'ab') as f:
+        f.write(b'\x03\x00\x00\x00cut short')
+    recovered = Validator(0, StoredBlock(None, store=BlockStore()), val_set.weight)
+    WriteAheadLog(str(tmp_path / 'validator'), recovered.tree.root.block.store).replay_into_validator(recovered)
+    assert recovered.forkchoice().index == val.forkchoice().index
+    assert len(recovered.justification) == len(val.justification)
+    for name, message in val.latest_messages.items():
+        assert recovered.latest_messages[name].block.index == message.block.index
+
+    # votes after a snapshot are replayed into the snapshot's tree
+    tree = CompressedTree(val_set.genesis)
+    with WriteAheadLog(str(tmp_path / 'tree'), store, batch_bytes=100) as wal:
+        for i, message in enumerate(messages):
+            wal.log_votes([(message.block, message.sender)])
+            tree.add_new_latest_block(message.block, message.sender)
+            if i == len(messages) // 2:
+                segment = wal.checkpoint()
+                write_snapshot(str(tmp_path / 'tree.snap'), store, tree)
+                wal.remove_segments_before(segment)
+    loaded_store, loaded = load_snapshot(str(tmp_path / 'tree.snap'))
+    WriteAheadLog(str(tmp_path / 'tree'), loaded_store).replay_into_tree(loaded)
+    assert loaded.find_head().block.index == tree.find_head().block.index
+    assert loaded.size == tree.size
+
+
+def test_write_ahead_log_attached_mid_run(tmp_path):
+    store = BlockStore()
+    val_set = ValidatorSet(4, genesis=StoredBlock(None, store=store))
+    val = val_set.validators[0]
+
+    def run_rounds(rounds):
+        messages = []
+        for _ in range(rounds):
+            for other in val_set:
+                messages.append(other.make_new_message())
+            for other in val_set:
+                for message in random.sample(messages, 3):
+                    other.see_message(message)
+
+    # the messages seen before the log was attached are logged along with the first message
+    # that needs them
+    run_rounds(5)
+    val.wal = WriteAheadLog(str(tmp_path / 'validator'), store)
+    val.make_new_message()
+    run_rounds(5)
+    val.wal.close()
+
+    def recover(expected):
+        recovered = Validator(0, StoredBlock(None, store=BlockStore()), val_set.weight)
+        wal = WriteAheadLog(str(tmp_path / 'validator'), recovered.tree.root.block.store)
+        wal.replay_into_validator(recovered)
+        assert recovered.forkchoice().index == expected.forkchoice().index
+        assert len(recovered.justification) == len(expected.justification)
+        for name, message in expected.latest_messages.items():
+            assert recovered.latest_messages[name].block.index == message.block.index
+        return recovered, wal
+
+    recovered, wal = recover(val)
+
+    # a log with records in it can only be added to once it has been replayed
+    error = ''
+    try:
+        WriteAheadLog(str(tmp_path / 'validator'), store).log_weights({1: 1})
+    except Exception as e:
+        error = str(e)
+    assert 'replayed' in error
+
+    # once replayed, the recovered validator can keep logging to it
+    recovered.wal = wal
+    for _ in range(3):
+        recovered.make_new_message()
+    wal.close()
+    recover(recovered)
+
+
+def test_write_ahead_log_replays_weight_changes(tmp_path):
+    store = BlockStore()
+    val_set = ValidatorSet(3, genesis=StoredBlock(None, store=store))
+    val = val_set.validators[0]
+    val.wal = WriteAheadLog(str(tmp_path / 'validator'), store)
+    for _ in range(3):
+        messages = [other.make_new_message() for other in val_set]
+        for other in val_set:
+            for message in messages:
+                other.see_message(message)
+        val_set.set_validator_weights({1: 10})
+    val_set.set_validator_weights({2: 20})
+    val.wal.close()
+
+    recovered = Validator(0, StoredBlock(None, store=BlockStore()), dict())
+    WriteAheadLog(str(tmp_path / 'validator'), recovered.tree.root.block.store).replay_into_validator(recovered)
+    assert recovered.tree.validator_weight(1) == 10
+    assert recovered.tree.validator_weight(2) == 20
+    assert recovered.weight == {1: 10, 2: 20}
+    assert recovered.tree.root.score == val.tree.root.score
+    assert recovered.forkchoice().index == val.forkchoice().index
+
+
+def test_lca_index():
+    genesis = Block(None)
+    index = LCAIndex(genesis)
+    blocks = [genesis]
+    for i in range(2000):
+        parent = random.randint(max(0, i - 50), i)
+        blocks.append(Block(blocks[parent]))
+        if random.random() < 0.5:
+            assert index.add(blocks[-1])
+
+        block_1 = random.choice(blocks)
+        block_2 = random.choice(blocks)
+        lca = index.lca(block_1, block_2)
+        if block_1 in index and block_2 in index:
+            assert lca == block_1.lca(block_2)
+            height = random.randint(0, block_1.height)
+            assert index.prev_at_height(block_1, height) == block_1.prev_at_height(height)
+        else:
+            assert lca is None
+
+    # blocks that are not on top of the root are not indexed
+    assert not index.add(Block(None))
+    index.prune(blocks[100])
+    assert blocks[99] not in index
+    assert not index.add(blocks[99])
+
+
+def test_tree_with_lca_index():
+    genesis = Block(None)
+    tree = CompressedTree(genesis, use_lca_index=True)
+
+    for i in range(3):
+        block = Block(genesis)
+        _ = tree.add_new_latest_block(block, i)
+
+    for i in range(300):
+        prev_val = random.randint(0, 2)
+        new_block = Block(tree.latest_block_nodes[prev_val].block)
+        new_val = random.randint(0, 2)
+        tree.add_new_latest_block(new_block, new_val)
+        assert tree.size <= 6
+
+    assert len(tree.lca_index) == 304
+
+
+def test_tree_finds_prev_blocks_through_lca_index():
+    rng = random.Random(4)
+    genesis = Block(None)
+    blocks = [genesis]
+    for _ in range(2000):
+        blocks.append(Block(rng.choice(blocks[-20:])))
+
+    trees = [CompressedTree(genesis), CompressedTree(genesis, use_lca_index=True)]
+    queries = []
+    index_prev_at_height = trees[1].lca_index.prev_at_height
+
+    def counted_prev_at_height(block, height):
+        queries.append(height)
+        return index_prev_at_height(block, height)
+    trees[1].lca_index.prev_at_height = counted_prev_at_height
+
+    for tree in trees:
+        for idx in range(0, len(blocks), 7):
+            tree.add_new_latest_block(blocks[idx], idx % 5)
+            if idx % 3 == 0:
+                tree.remove_latest_block((idx + 1) % 5)
+    assert trees[0].find_head().block == trees[1].find_head().block
+    assert trees[0].size == trees[1].size
+    assert len(queries) > 0
+
+
+def test_find_prev_in_tree_across_forks():
+    genesis = Block(None)
+    tree = CompressedTree(genesis)
+
+    # validator 0 has a long chain, validator 1 forks off it at height 1
+    chain = [genesis]
+    for _ in range(10):
+        chain.append(Block(chain[-1]))
+    tree.add_new_latest_block(chain[10], 0)
+    fork = Block(Block(chain[1]))
+    tree.add_new_latest_block(fork, 1)
+
+    # there are nodes at heights 10, 3, 1 and 0, but only the ones at 1 and 0 are ancestors
+    # of a block on top of chain[5]
+    block = Block(chain[5])
+    assert tree.find_prev_node_in_tree(block).block == chain[1]
+    assert tree.find_prev_node_in_tree(Block(fork)).block == fork
+    assert tree.find_prev_node_in_tree(Block(chain[10])).block == chain[10]
+    assert tree.find_prev_node_in_tree(chain[1]).block == chain[1]
+    assert tree.find_prev_node_in_tree(Block(None)) is None
+
+
+def test_find_prev_in_tree_with_dfs_order(monkeypatch):
+    # only search the dfs order, without first checking heights one by one
+    monkeypatch.setattr(cbc_lmd.main, 'HEIGHTS_TO_SCAN', 0)
+
+    genesis = Block(None)
+    tree = CompressedTree(genesis)
+    blocks = [genesis]
+    for i in range(300):
+        blocks.append(Block(blocks[random.randint(max(0, i - 30), i)]))
+
+    for _ in range(300):
+        tree.add_new_latest_block(random.choice(blocks), random.randint(0, 20))
+
+        block = random.choice(blocks)
+        prev_block = block
+        while prev_block not in tree.node_with_block:
+            prev_block = prev_block.parent_block
+        assert tree.find_prev_node_in_tree(block).block == prev_block
+
+
+def test_add_new_latest_blocks_matches_one_by_one():
+    genesis = Block(None)
+    one_by_one = CompressedTree(genesis, {0: 3})
+    batched = CompressedTree(genesis, {0: 3})
+
+    blocks = [genesis]
+    for i in range(200):
+        blocks.append(Block(blocks[random.randint(max(0, i - 10), i)]))
+
+    for _ in range(20):
+        # validators can appear more than once in a batch, and only their last block counts
+        updates = [(random.choice(blocks), random.randint(0, 9)) for _ in range(15)]
+        for block, validator in updates:
+            one_by_one.add_new_latest_block(block, validator)
+        new_nodes = batched.add_new_latest_blocks(updates)
+
+        assert set(new_nodes) == {validator for _, validator in updates}
+        assert set(one_by_one.node_with_block) == set(batched.node_with_block)
+        assert set(one_by_one.path_block_to_child_node) == set(batched.path_block_to_child_node)
+        for block, node in one_by_one.node_with_block.items():
+            batched_node = batched.node_with_block[block]
+            assert node.score == batched_node.score
+            assert node.validators == batched_node.validators
+            assert {c.block for c in node.children} == {c.block for c in batched_node.children}
+        for validator, node in batched.latest_block_nodes.items():
+            assert node.block == one_by_one.latest_block_nodes[validator].block
+
+
+class CollidingKey:
+    # keys with only a few different hashes
+    def __init__(self, key: int) -> None:
+        self.key = key
+
+    def __hash__(self) -> int:
+        return self.key % 3
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, CollidingKey) and self.key == other.key
+
+
+def test_persistent_map():
+    versions = [(PersistentMap(), dict())]
+    for _ in range(500):
+        old_map, old_dict = random.choice(versions)
+        key = random.choice([random.randint(0, 100), CollidingKey(random.randint(0, 10)), random.getrandbits(80)])
+        value = random.randint(0, 3)
+        new_dict = dict(old_dict)
+        new_dict[key] = value
+        versions.append((old_map.set(key, value), new_dict))
+
+    # setting a key leaves the old versions as they were
+    for persistent_map, expected in versions:
+        assert len(persistent_map) == len(expected)
+        assert persistent_map.to_dict() == expected
+        for key, value in expected.items():
+            assert key in persistent_map
+            assert persistent_map[key] == value
+        assert -1 not in persistent_map
+        assert persistent_map.get(CollidingKey(11)) is None
+
+    persistent_map = PersistentMap({1: 'a', 2: 'b'})
+    assert persistent_map.set(1, 'a') is persistent_map
+    assert persistent_map.update({2: 'c', 3: 'd'}).to_dict() == {1: 'a', 2: 'c', 3: 'd'}
+
+
+def test_messages_share_latest_messages():
+    val_set = ValidatorSet(3)
+    for _ in range(10):
+        for val in val_set.validators.values():
+            message = val.make_new_message()
+            for other in val_set.validators.values():
+                other.see_message(message)
+
+    for val in val_set.validators.values():
+        latest_messages = val.latest_messages
+        message = val.make_new_message()
+        # the message keeps the validator's map, rather than a copy of it
+        assert message.latest_messages is latest_messages
+        assert set(message.latest_messages) == {0, 1, 2}
+        assert val.latest_messages[val.name] == message
+        assert message.latest_messages[val.name] == message.prev_message
+
+
+def test_see_message_after_downtime():
+    val_set = ValidatorSet(4)
+    validators = list(val_set.validators.values())
+    # validator 3 is offline while the others keep building on each other
+    for _ in range(30):
+        for val in validators[:3]:
+            message = val.make_new_message()
+            for other in validators[:3]:
+                if other != val:
+                    other.see_message(message)
+
+    synced = validators[0]
+    catching_up = validators[3]
+    unseen = catching_up.unseen_justification(message)
+    # messages come after the messages they justify
+    position = {m: idx for idx, m in enumerate(unseen)}
+    for m in unseen:
+        for prev_message in m.latest_messages.values():
+            assert position[prev_message] < position[m]
+    assert unseen[-1] == message
+
+    catching_up.see_message(message)
+    assert catching_up.justification == set(unseen)
+    assert len(catching_up.justification) == 90
+    for name in range(3):
+        expected = message if name == message.sender else message.latest_messages[name]
+        assert catching_up.latest_messages[name] == expected
+        assert catching_up.tree.latest_block_nodes[name].block == catching_up.latest_messages[name].block
+    assert catching_up.unseen_justification(message) == []
+    assert catching_up.forkchoice() == synced.tree.latest_block_nodes[2].block
+
+
+def test_head_is_only_recomputed_after_changes():
+    genesis = Block(None)
+    tree = CompressedTree(genesis)
+    chain = [genesis]
+    for _ in range(5):
+        chain.append(Block(chain[-1]))
+    fork = Block(chain[2])
+    tree.add_new_latest_block(chain[5], 0)
+    tree.add_new_latest_block(fork, 1)
+    tree.add_new_latest_block(chain[4], 2)
+
+    assert tree.find_head().block == chain[5]
+    version = tree.version
+    assert tree.find_head().block == chain[5]
+    assert tree.version == version
+    assert tree.head_dirty_from is None
+
+    tree.add_new_latest_block(fork, 2)
+    assert tree.version != version
+    # GHOST only needs to look again below the node the fork branches off from
+    assert tree.head_dirty_from == tree.head_path_index[tree.node_with_block[chain[2]]]
+    assert tree.find_head().block in {chain[5], fork}
+    tree.add_new_latest_block(fork, 0)
+    assert tree.find_head().block == fork
+
+    val_set = ValidatorSet(2)
+    val = val_set.validators[0]
+    head = val.forkchoice()
+    assert val.forkchoice() is head
+    message = val_set.make_new_message(1)
+    val.see_message(message)
+    assert val.forkchoice() == message.block
+
+
+def test_cached_head_matches_fresh_ghost():
+    rng = random.Random(11)
+
+    def assert_head_is_fresh(tree):
+        # GHOST over scores calculated from scratch, from the weight of each node's validators
+        weight = dict()
+        for name, node in tree.latest_block_nodes.items():
+            if node is not None:
+                weight[node.block] = weight.get(node.block, 0) + tree.validator_weight(name)
+        assert tree.find_head().block == tree.find_head(weight).block
+
+    for _ in range(20):
+        genesis = Block(None)
+        blocks = [genesis]
+        tree = CompressedTree(genesis, weight={v: rng.randint(1, 4) for v in range(6)})
+        for _ in range(150):
+            blocks.append(Block(rng.choice(blocks[-10:])))
+            choice = rng.random()
+            if choice < .4:
+                tree.add_new_latest_block(rng.choice(blocks[-10:]), rng.randrange(6))
+            elif choice < .5:
+                tree.remove_latest_block(rng.randrange(6))
+            elif choice < .7:
+                tree.add_new_latest_blocks(
+                    (rng.choice(blocks[-10:]), rng.randrange(6)) for _ in range(rng.randint(1, 4))
+                )
+            elif choice < .8:
+                tree.set_validator_weight(rng.randrange(6), rng.randint(0, 4))
+            elif choice < .95:
+                with tree.fork():
+                    tree.add_new_latest_block(rng.choice(blocks[-10:]), rng.randrange(7))
+                    tree.set_validator_weight(rng.randrange(7), rng.randint(0, 4))
+                    assert_head_is_fresh(tree)
+            elif len(tree.root.children) > 0:
+                tree.prune(rng.choice(list(tree.root.children)))
+            assert_head_is_fresh(tree)
+
+
+def test_set_validator_weights():
+    genesis = Block(None)
+    tree = CompressedTree(genesis, weight={0: 3})
+    chain = [genesis]
+    for _ in range(4):
+        chain.append(Block(chain[-1]))
+    fork = Block(chain[1])
+    tree.add_new_latest_block(chain[4], 0)
+    tree.add_new_latest_block(fork, 1)
+    tree.add_new_latest_block(fork, 2)
+    assert tree.find_head().block == chain[4]
+
+    # only the path from the validators' latest block to the root is scored again
+    version = tree.version
+    tree.set_validator_weights({1: 2, 2: 2, 5: 10})
+    assert tree.version != version
+    assert tree.node_with_block[fork].score == 4
+    assert tree.root.score == 7
+    assert tree.find_head().block == fork
+
+    # weights changed in a fork are changed back
+    with tree.fork():
+        tree.set_validator_weight(0, 10)
+        tree.set_validator_weight(3, 10)
+        assert tree.find_head().block == chain[4]
+    assert tree.weight == {0: 3, 1: 2, 2: 2, 5: 10}
+    assert tree.root.score == 7
+    assert tree.find_head().block == fork
+
+    val_set = ValidatorSet(2)
+    messages = [val_set.make_new_message(name) for name in range(2)]
+    val_set.send_message(messages[0], 1)
+    val_set.send_message(messages[1], 0)
+    val_set.set_validator_weights({0: 5})
+    for val in val_set:
+        assert val.tree.latest_block_nodes[0].weight == 5
+        assert val.forkchoice() == val.tree.latest_block_nodes[0].block
+
+
+def test_validating_messages_in_a_fork():
+    val_set = ValidatorSet(3, weight={0: 1, 1: 2, 2: 3})
+    validators = list(val_set.validators.values())
+    for _ in range(10):
+        for val in validators:
+            message = val.make_new_message()
+            for other in validators:
+                if other != val:
+                    # every message builds on the head of its own justification
+                    assert other.message_is_valid(message)
+                    other.see_message(message)
+
+    val = validators[0]
+    head = val.forkchoice()
+    sizes = (val.tree.size, len(val.tree.path_block_to_child_node))
+    # a message that builds on an old block is not valid
+    message = validators[1].make_new_message()
+    message.block = Block(message.block.parent_block.parent_block)
+    assert not val.message_is_valid(message)
+
+    # validating leaves the tree as it was
+    assert val.forkchoice() == head
+    assert (val.tree.size, len(val.tree.path_block_to_child_node)) == sizes
+    for name in range(3):
+        assert val.tree.latest_block_nodes[name].block == val.latest_messages[name].block
+
+    with val.tree.fork():
+        val.tree.add_new_latest_block(Block(val_set.genesis), 5)
+        assert 5 in val.tree.latest_block_nodes
+    assert 5 not in val.tree.latest_block_nodes